@@ -0,0 +1,8 @@
+# Read the HDF5 files of the detectors (AD_HDF5_SWMR spec), even during
+# acquisition, with the handler of the collection profile (defined there
+# only, and registered on this profile's db).
+import os
+
+exec(open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       '..', '..', 'profile_collection', 'startup',
+                       '79-hdf5-swmr-handler.py')).read())
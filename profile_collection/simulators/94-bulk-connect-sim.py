@@ -0,0 +1,22 @@
+# Exercise lazy devices and bulk_connect without the beamline.
+#
+# Run with the startup/05-lazy-devices.py definitions loaded. For a real
+# channel access stand-in, start caproto's example IOC first:
+#
+#     python -m caproto.ioc_examples.simple --list-pvs
+#
+# which serves simple:A, simple:B and simple:C. The 'sim:missing' PV is
+# never served and should be the only one reported as unreachable.
+
+from ophyd import EpicsSignal
+from ophyd.sim import SynAxis
+
+sim_motor = lazy_device(SynAxis, name='sim_motor')
+sim_a = lazy_device(EpicsSignal, 'simple:A', name='sim_a')
+sim_b = lazy_device(EpicsSignal, 'simple:B', name='sim_b')
+sim_missing = lazy_device(EpicsSignal, 'sim:missing', name='sim_missing')
+
+lazy_report()
+unreachable = bulk_connect([sim_motor, sim_a, sim_b, sim_missing], timeout=2)
+assert unreachable == ['sim:missing'], unreachable
+lazy_report()
@@ -0,0 +1,27 @@
+# Compare the adaptive and all-reflection energy calibrations with the fixed
+# grid one on the simulated Si dips of 10-motors-dets-sim.py
+# (current_intensity_dips, read by `sc` as 'det', on `th_cal`).
+#
+# Ecal asks for a y/n confirmation at the end; any answer will do.
+
+import os
+from bluesky.callbacks import CallbackCounter
+
+# Ecal, Ecal_adaptive and Ecal_multi as they are in the startup profile
+exec(open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       '..', 'startup', '91-plans-ecal.py')).read())
+
+# wavelength of the simulation, and a guess 0.3% off
+SIM_WAVELENGTH = 12.398 / 66.4
+wguess = SIM_WAVELENGTH * 1.003
+
+counts = {}
+for plan in (Ecal, Ecal_adaptive, Ecal_multi):
+    counter = CallbackCounter()
+    RE(plan(wguess, detectors=[sc], motor=th_cal, detector_name='det'),
+       {'event': counter})
+    counts[plan.__name__] = (counter.value, myresult.wavelength)
+
+for name, (n_points, wavelength) in counts.items():
+    print('{:<14} {:4d} points, wavelength {:.6f} A (error {:.1e})'.format(
+        name, n_points, wavelength, wavelength - SIM_WAVELENGTH))
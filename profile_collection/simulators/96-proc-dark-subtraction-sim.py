@@ -0,0 +1,130 @@
+# Check the dark subtraction in the IOC (ProcDarkSubtraction, and
+# dark_frame_plan loading the ProcessPlugin background) on a stand-in
+# PerkinElmer: the frames it writes are summarized by their mean in 'image'.
+#
+# The ProcessPlugin is emulated with NumPy as far as it is used: background
+# subtraction, then averaging of the images of a set ("tiff squashing"),
+# then conversion to the output type. SaveBackground saves its last output.
+
+import os
+import numpy as np
+import ophyd
+from ophyd import Device, EpicsMotor, Signal
+from ophyd import Component as C
+from ophyd.device import DeviceStatus
+import bluesky.plan_stubs as bps
+from bluesky.plans import count
+
+startup_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           '..', 'startup')
+# 80-areadetector.py only declares the real detectors (see lazy_device),
+# so none of them is connected here
+for filename in ('05-lazy-devices.py', '80-areadetector.py'):
+    exec(open(os.path.join(startup_dir, filename)).read())
+
+DARK_LEVEL = 1000
+BEAM_LEVEL = 200
+
+
+class SimProcessPlugin(Device):
+    enable_background = C(Signal, value=0)
+    save_background = C(Signal, value=0)
+    data_type_out = C(Signal, value='Automatic')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.background = None
+        self.last_output = None
+        self.save_background.subscribe(self._save_background, run=False)
+
+    def _save_background(self, value, **kwargs):
+        if value:
+            self.background = self.last_output.astype(float)
+            self.save_background.put(0)
+
+    def process(self, frames):
+        frames = frames.astype(float)
+        if self.enable_background.get() and self.background is not None:
+            frames = frames - self.background
+        output = frames.mean(axis=0)
+        if self.data_type_out.get() != 'Float32':
+            output = np.clip(output, 0, 2**16 - 1).astype(np.uint16)
+        self.last_output = output
+        return output
+
+
+class SimCam(Device):
+    acquire_time = C(Signal, value=.1)
+
+
+class SimPerkinElmer(ProcDarkSubtraction, Device):
+    cam = C(SimCam, '')
+    proc = C(SimProcessPlugin, '')
+    images_per_set = C(Signal, value=5)
+    subtract_dark = C(Signal, value=1)
+    image = C(Signal, value=0.)
+
+    def trigger(self):
+        shape = (self.images_per_set.get(), 64, 64)
+        frames = (DARK_LEVEL * self.cam.acquire_time.get() / .1 +
+                  BEAM_LEVEL * sim_shutter.get() +
+                  np.random.normal(0, 5, shape))
+        self.image.put(self.proc.process(frames).mean())
+        status = DeviceStatus(self)
+        status._finished()
+        return status
+
+
+sim_shutter = Signal(name='sim_shutter', value=1)
+sim_pe = SimPerkinElmer('', name='sim_pe', read_attrs=['image'])
+
+starts = []
+images = []
+RE.subscribe(lambda name, doc: starts.append(doc), 'start')
+RE.subscribe(lambda name, doc: images.append(doc['data']['sim_pe_image']),
+             'event')
+
+
+def run(**md):
+    del starts[:], images[:]
+    RE(dark_frame_wrapper(count([sim_pe], 3, md=md), [sim_pe],
+                          shutter=sim_shutter))
+    darks = [doc['uid'] for doc in starts if doc.get('dark_frame')]
+    light = [doc for doc in starts if not doc.get('dark_frame')][0]
+    return darks, light, images[-3:]
+
+
+darks, light, frames = run()
+assert len(darks) == 1, "a first dark is taken"
+assert light['dark_frame_uids'] == {'sim_pe': darks[0]}
+assert light['dark_subtracted'] == ['sim_pe']
+assert np.allclose(frames, BEAM_LEVEL, atol=1), frames
+
+darks, light, frames = run()
+assert not darks, "the dark is reused"
+assert np.allclose(frames, BEAM_LEVEL, atol=1), frames
+
+sim_pe.cam.acquire_time.put(.2)
+darks, light, frames = run()
+assert len(darks) == 1, "a new dark is taken for a new acquire time"
+assert np.allclose(frames, BEAM_LEVEL, atol=1), frames
+
+sim_pe.cam.acquire_time.put(.1)
+darks, light, frames = run()
+assert len(darks) == 1, "the background in proc is the dark of .2 s"
+assert np.allclose(frames, BEAM_LEVEL, atol=1), frames
+
+sim_pe.cam.acquire_time.put(.2)
+sim_pe.subtract_dark.put(0)
+dark_frame_cache.clear(sim_pe)
+darks, light, frames = run()
+assert np.allclose(frames, 2 * DARK_LEVEL + BEAM_LEVEL, atol=1), frames
+assert light['dark_subtracted'] == []
+
+sim_pe.subtract_dark.put(1)
+darks, light, frames = run()
+assert len(darks) == 1, "a dark cached without subtraction is not loaded"
+assert np.allclose(frames, BEAM_LEVEL, atol=1), frames
+
+print("The frames were dark subtracted in the (simulated) IOC, "
+      "with a dark taken only when needed.")
@@ -0,0 +1,178 @@
+"Time each startup file (and the imports and connections in it), and flag regressions"
+
+# This file must sort before all the others: it wraps the shell's
+# safe_execfile, which IPython calls for every remaining startup file.
+
+import builtins
+import glob
+import json
+import os
+import shutil
+import threading
+import time as ttime
+
+
+class StartupProfiler:
+    """
+    Record wall time, import time and device connection time (as waited
+    for in ``bulk_connect``) per startup file.
+
+    After the last startup file, or the first one that raises, a JSON
+    report is written to ``<profile>/log/startup/`` (one per launch, plus
+    ``latest.json``) and compared to ``baseline.json`` if there is one.
+    """
+    def __init__(self, ip):
+        self.ip = ip
+        self.report_dir = os.path.join(ip.profile_dir.location,
+                                       'log', 'startup')
+        self.started = ttime.time()
+        self.files = []
+        self._t0 = ttime.perf_counter()
+        self._import_time = 0
+        self._importing = False
+        self._main_thread = threading.get_ident()
+        self._finished = False
+        startup_files = sorted(glob.glob(
+            os.path.join(ip.profile_dir.startup_dir, '*.py')))
+        self._last_file = startup_files[-1] if startup_files else None
+        self._orig_execfile = ip.safe_execfile
+        self._orig_import = builtins.__import__
+
+    def install(self):
+        self.ip.safe_execfile = self._execfile
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        del self.ip.safe_execfile
+        builtins.__import__ = self._orig_import
+
+    def _import(self, *args, **kwargs):
+        # only time the outermost import, and only on the main thread
+        if self._importing or threading.get_ident() != self._main_thread:
+            return self._orig_import(*args, **kwargs)
+        self._importing = True
+        t0 = ttime.perf_counter()
+        try:
+            return self._orig_import(*args, **kwargs)
+        finally:
+            self._import_time += ttime.perf_counter() - t0
+            self._importing = False
+
+    def _connect_time(self):
+        return sum(dev._lazy_connect_time for dev in
+                   self.ip.user_ns.get('lazy_devices', [])
+                   if dev._lazy_connect_time is not None)
+
+    def _execfile(self, fname, *args, **kwargs):
+        t0 = ttime.perf_counter()
+        import0 = self._import_time
+        connect0 = self._connect_time()
+        failed = False
+        try:
+            return self._orig_execfile(fname, *args, **kwargs)
+        except BaseException:
+            # the remaining startup files will not be run
+            failed = True
+            raise
+        finally:
+            self.files.append({
+                'file': os.path.basename(fname),
+                'wall': ttime.perf_counter() - t0,
+                'import': self._import_time - import0,
+                'connect': self._connect_time() - connect0})
+            if failed or fname == self._last_file:
+                self.finish()
+
+    def report(self):
+        "The report, as written to disk."
+        devices = [{'name': dev.name, 'class': dev._lazy_cls.__name__,
+                    'construct': dev._lazy_time,
+                    'connect': dev._lazy_connect_time}
+                   for dev in self.ip.user_ns.get('lazy_devices', [])
+                   if dev._lazy_time is not None]
+        return {'time': self.started,
+                'total': ttime.perf_counter() - self._t0,
+                'files': self.files,
+                'devices': devices}
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self.uninstall()
+        report = self.report()
+        os.makedirs(self.report_dir, exist_ok=True)
+        stamp = ttime.strftime('%Y%m%d-%H%M%S', ttime.localtime(self.started))
+        path = os.path.join(self.report_dir, 'startup-{}.json'.format(stamp))
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+        shutil.copy(path, os.path.join(self.report_dir, 'latest.json'))
+        print('Startup took {:.1f} s (report: {})'.format(report['total'],
+                                                          path))
+        check_startup_regressions(report)
+
+
+def _load_startup_report(name):
+    path = os.path.join(startup_profiler.report_dir, name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_startup_baseline():
+    "Use the report of the latest launch as the baseline for later ones."
+    shutil.copy(os.path.join(startup_profiler.report_dir, 'latest.json'),
+                os.path.join(startup_profiler.report_dir, 'baseline.json'))
+
+
+def check_startup_regressions(report=None, baseline=None, factor=1.5,
+                              min_delta=0.5):
+    """
+    Compare a startup report to the baseline and print the slower files.
+
+    Parameters
+    ----------
+    report, baseline : dict, optional
+        default to the latest report and the saved baseline
+    factor : float, optional
+        a file is flagged if it is ``factor`` times slower than the baseline
+    min_delta : float, optional
+        ... and at least ``min_delta`` seconds slower
+
+    Returns
+    -------
+    regressions : list
+        (file, baseline time, new time) tuples
+    """
+    if report is None:
+        report = _load_startup_report('latest.json')
+    if baseline is None:
+        baseline = _load_startup_report('baseline.json')
+    if report is None or baseline is None:
+        return []
+    before = {f['file']: f['wall'] for f in baseline['files']}
+    regressions = [(f['file'], before[f['file']], f['wall'])
+                   for f in report['files']
+                   if f['file'] in before and
+                   f['wall'] > factor * before[f['file']] and
+                   f['wall'] - before[f['file']] > min_delta]
+    for fname, old, new in regressions:
+        print('WARNING: startup file {} took {:.1f} s, {:.1f} s in the '
+              'baseline'.format(fname, new, old))
+    return regressions
+
+
+def startup_summary(report=None, n=10):
+    "Print the slowest startup files of a report (the latest by default)."
+    if report is None:
+        report = _load_startup_report('latest.json')
+    print('{:<40} {:>8} {:>8} {:>8}'.format('file', 'wall', 'import',
+                                            'connect'))
+    for f in sorted(report['files'], key=lambda f: -f['wall'])[:n]:
+        print('{file:<40} {wall:8.2f} {import:8.2f} {connect:8.2f}'.format(
+            **f))
+
+
+startup_profiler = StartupProfiler(get_ipython())
+startup_profiler.install()
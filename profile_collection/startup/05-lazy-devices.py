@@ -0,0 +1,168 @@
+"Declare devices at startup but only construct (and connect) them on first use"
+
+import time as ttime
+
+
+# every device declared with lazy_device (names are not unique, e.g. the
+# pe2/pe2m/pe2c variants of a detector are all named 'pe2')
+lazy_devices = []
+
+
+class LazyDevice:
+    """
+    Stand-in for an ophyd device that is constructed on first use.
+
+    Accessing or setting any attribute other than ``name`` (e.g. when the
+    device is read, moved or passed to a plan) constructs the real device
+    and forwards to it. ``isinstance`` checks and tab completion use the
+    device class, without constructing it.
+
+    Parameters
+    ----------
+    cls : type
+        the device class
+    *args, **kwargs
+        passed to ``cls``
+    configure : callable, optional
+        called with the device right after it is constructed, for the
+        settings normally done on the instance after creating it
+    """
+    def __init__(self, cls, *args, configure=None, **kwargs):
+        object.__setattr__(self, '_lazy_cls', cls)
+        object.__setattr__(self, '_lazy_args', args)
+        object.__setattr__(self, '_lazy_kwargs', kwargs)
+        object.__setattr__(self, '_lazy_configure', configure)
+        object.__setattr__(self, '_lazy_obj', None)
+        object.__setattr__(self, '_lazy_time', None)
+        object.__setattr__(self, '_lazy_connect_time', None)
+
+    @property
+    def __class__(self):
+        return self._lazy_cls
+
+    @property
+    def name(self):
+        if self._lazy_obj is None:
+            return self._lazy_kwargs.get('name')
+        return self._lazy_obj.name
+
+    @property
+    def lazy_constructed(self):
+        return self._lazy_obj is not None
+
+    def lazy_construct(self):
+        "Construct the device now, if it is not yet, and return it."
+        if self._lazy_obj is None:
+            t0 = ttime.time()
+            obj = self._lazy_cls(*self._lazy_args, **self._lazy_kwargs)
+            if self._lazy_configure is not None:
+                self._lazy_configure(obj)
+            object.__setattr__(self, '_lazy_obj', obj)
+            object.__setattr__(self, '_lazy_time', ttime.time() - t0)
+        return self._lazy_obj
+
+    def __getattr__(self, attr):
+        if attr.startswith('_lazy_'):
+            raise AttributeError(attr)
+        return getattr(self.lazy_construct(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.lazy_construct(), attr, value)
+
+    def __dir__(self):
+        return dir(self._lazy_cls)
+
+    def __repr__(self):
+        if self._lazy_obj is None:
+            return '<lazy {}(name={!r})>'.format(self._lazy_cls.__name__,
+                                                self.name)
+        return repr(self._lazy_obj)
+
+
+def lazy_device(cls, *args, configure=None, **kwargs):
+    """
+    Declare a device that is only constructed when it is first used.
+
+    Takes the same arguments as ``cls``, plus an optional ``configure``
+    callback (see ``LazyDevice``).
+
+    Example
+    -------
+    >>> th = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:Th}Mtr', name='th')
+    """
+    dev = LazyDevice(cls, *args, configure=configure, **kwargs)
+    lazy_devices.append(dev)
+    return dev
+
+
+def construct_lazy_devices(*names):
+    """Construct the named lazy devices, or all of them if none are named."""
+    for dev in lazy_devices:
+        if not names or dev.name in names:
+            dev.lazy_construct()
+
+
+def lazy_report():
+    """Print which lazy devices have been constructed and how long it took."""
+    built = [dev for dev in lazy_devices if dev.lazy_constructed]
+    print('{} of {} declared devices constructed'.format(len(built),
+                                                         len(lazy_devices)))
+    for dev in sorted(built, key=lambda dev: -dev._lazy_time):
+        print('  {:<20} {:<24} {:8.3f} s'.format(
+            dev.name, dev._lazy_cls.__name__, dev._lazy_time))
+
+
+def bulk_connect(devices=None, timeout=5):
+    """
+    Connect many devices at once, with one overall timeout.
+
+    Constructing a device only starts the channel access searches for its
+    PVs, so all the devices are constructed first and their searches run
+    concurrently; then they are all waited on against a single deadline.
+    PVs that did not connect are reported together at the end, instead of
+    stalling device after device.
+
+    Parameters
+    ----------
+    devices : list, optional
+        devices or lazy devices, defaults to all declared lazy devices
+    timeout : float, optional
+        overall timeout in seconds
+
+    Returns
+    -------
+    unreachable : list
+        names of the PVs that did not connect
+    """
+    if devices is None:
+        devices = lazy_devices
+    t0 = ttime.monotonic()
+    lazy = [dev if type(dev) is LazyDevice else None for dev in devices]
+    devices = [dev.lazy_construct() if type(dev) is LazyDevice else dev
+               for dev in devices]
+    deadline = t0 + timeout
+    for dev, lazy_dev in zip(devices, lazy):
+        t1 = ttime.monotonic()
+        try:
+            dev.wait_for_connection(timeout=max(deadline - t1, 1e-3))
+        except TimeoutError:
+            pass
+        if lazy_dev is not None:
+            # the time waited for this device once the previous ones were up
+            object.__setattr__(lazy_dev, '_lazy_connect_time',
+                               ttime.monotonic() - t1)
+
+    unreachable = []
+    for dev in devices:
+        if hasattr(dev, 'walk_signals'):
+            signals = [walk.item for walk in dev.walk_signals()]
+        else:
+            signals = [dev]
+        unreachable.extend(getattr(sig, 'pvname', sig.name)
+                           for sig in signals if not sig.connected)
+    print('Connected {} devices in {:.1f} s'.format(
+        len(devices), ttime.monotonic() - t0))
+    if unreachable:
+        print('WARNING: {} PVs did not connect within {} s:\n    {}'.format(
+            len(unreachable), timeout, '\n    '.join(unreachable)))
+    return unreachable
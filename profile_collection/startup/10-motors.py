@@ -4,34 +4,34 @@ from ophyd import EpicsMotor
 import ophyd
 from ophyd import EpicsSignal
 
-th_cal = EpicsMotor('XF:28IDC-ES:1{Dif:2-Ax:Th}Mtr', name='th_cal')
-tth_cal = EpicsMotor('XF:28IDC-ES:1{Dif:2-Ax:2Th}Mtr', name='tth_cal')
-ecal_x = EpicsMotor('XF:28IDC-ES:1{Dif:2-Ax:X}Mtr', name='ecal_x')
-ecal_y = EpicsMotor('XF:28IDC-ES:1{Dif:2-Ax:Y}Mtr', name='ecal_y')
+th_cal = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:2-Ax:Th}Mtr', name='th_cal')
+tth_cal = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:2-Ax:2Th}Mtr', name='tth_cal')
+ecal_x = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:2-Ax:X}Mtr', name='ecal_x')
+ecal_y = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:2-Ax:Y}Mtr', name='ecal_y')
 
 # Tim test with Sanjit. Delete it if anything goes wrong
-ss_stg2_x = EpicsMotor('XF:28IDC-ES:1{Stg:Smpl2-Ax:X}Mtr', name='ss_stg2_x')
+ss_stg2_x = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Stg:Smpl2-Ax:X}Mtr', name='ss_stg2_x')
 # Sanjit Inlcuded this. Delete it if anything goes wrong
-ss_stg2_y = EpicsMotor('XF:28IDC-ES:1{Stg:Smpl2-Ax:Y}Mtr', name='ss_stg2_y')
-ss_stg2_z = EpicsMotor('XF:28IDC-ES:1{Stg:Smpl2-Ax:Z}Mtr', name='ss_stg2_z')
+ss_stg2_y = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Stg:Smpl2-Ax:Y}Mtr', name='ss_stg2_y')
+ss_stg2_z = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Stg:Smpl2-Ax:Z}Mtr', name='ss_stg2_z')
 
 # RPI DIFFRACTOMETER motors ### Change th only after changing in other plans
-th = EpicsMotor('XF:28IDC-ES:1{Dif:1-Ax:Th}Mtr', name='th')
-tth = EpicsMotor('XF:28IDC-ES:1{Dif:1-Ax:2ThI}Mtr', name='tth')
-diff_x = EpicsMotor('XF:28IDC-ES:1{Dif:1-Ax:X}Mtr', name='diff_x')
-diff_y = EpicsMotor('XF:28IDC-ES:1{Dif:1-Ax:Y}Mtr', name='diff_y')
-diff_tth_i = EpicsMotor('XF:28IDC-ES:1{Dif:1-Ax:2ThI}Mtr', name='diff_tth_i')
-diff_tth_o = EpicsMotor('XF:28IDC-ES:1{Dif:1-Ax:2ThO}Mtr', name='diff_tth_o')
+th = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:Th}Mtr', name='th')
+tth = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:2ThI}Mtr', name='tth')
+diff_x = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:X}Mtr', name='diff_x')
+diff_y = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:Y}Mtr', name='diff_y')
+diff_tth_i = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:2ThI}Mtr', name='diff_tth_i')
+diff_tth_o = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Dif:1-Ax:2ThO}Mtr', name='diff_tth_o')
 
-hrm_y = EpicsMotor('XF:28IDC-OP:1{Mono:HRM-Ax:Y}Mtr', name='hrm_y')
-hrm_b = EpicsMotor('XF:28IDC-OP:1{Mono:HRM-Ax:P}Mtr', name='hrm_b')
-hrm_r = EpicsMotor('XF:28IDC-OP:1{Mono:HRM-Ax:R}Mtr', name='hrm_r')
+hrm_y = lazy_device(EpicsMotor, 'XF:28IDC-OP:1{Mono:HRM-Ax:Y}Mtr', name='hrm_y')
+hrm_b = lazy_device(EpicsMotor, 'XF:28IDC-OP:1{Mono:HRM-Ax:P}Mtr', name='hrm_b')
+hrm_r = lazy_device(EpicsMotor, 'XF:28IDC-OP:1{Mono:HRM-Ax:R}Mtr', name='hrm_r')
 
 # PE detector motions
-pe1_x = EpicsMotor('XF:28IDC-ES:1{Det:PE1-Ax:X}Mtr', name='pe1_x')
-pe1_z = EpicsMotor('XF:28IDC-ES:1{Det:PE1-Ax:Z}Mtr', name='pe1_z')
+pe1_x = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Det:PE1-Ax:X}Mtr', name='pe1_x')
+pe1_z = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Det:PE1-Ax:Z}Mtr', name='pe1_z')
 
-shctl1 = EpicsMotor('XF:28IDC-ES:1{Sh2:Exp-Ax:5}Mtr', name='shctl1')
+shctl1 = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Sh2:Exp-Ax:5}Mtr', name='shctl1')
 
 
 class FilterBank(ophyd.Device):
@@ -40,5 +40,5 @@ class FilterBank(ophyd.Device):
     flt3 = ophyd.Component(EpicsSignal, '3-Cmd', string=True)
     flt4 = ophyd.Component(EpicsSignal, '4-Cmd', string=True)
 
-fb = FilterBank('XF:28IDC-OP:1{Fltr}Cmd:Opn', name='fb')
-p_diode = EpicsSignal('XF:28IDC-BI:1{IM:02}Pos-Cmd', name='p_diode', string=True)
+fb = lazy_device(FilterBank, 'XF:28IDC-OP:1{Fltr}Cmd:Opn', name='fb')
+p_diode = lazy_device(EpicsSignal, 'XF:28IDC-BI:1{IM:02}Pos-Cmd', name='p_diode', string=True)
@@ -4,16 +4,244 @@ from ophyd.mixins import EpicsSignalPositioner
 from ophyd import Component as C
 from ophyd import Component as Cpt
 from ophyd.device import DeviceStatus
+import threading
+import time as ttime
+from collections import deque
 
 
-class CS700TemperatureController(PVPositioner):
+class ThermalSettle:
+    """
+    Follow a temperature readback until it has settled at a new setpoint.
+
+    ``status`` is finished once the readback has stayed within
+    ``tolerance`` of ``target`` for ``window`` seconds, drifting by less
+    than ``max_drift``. The drift is the slope of a line fit to the
+    readings of the last ``window`` seconds; while the temperature is
+    still approaching the target it also gives ``eta``, the estimated
+    seconds left until the status finishes.
+
+    Parameters
+    ----------
+    device : Device
+        the device the status belongs to
+    readback : Signal
+    target : float
+    tolerance : float
+    window : float
+        seconds the temperature must stay within tolerance
+    max_drift : float
+        degrees per second
+    timeout : float, optional
+    on_done : callable, optional
+        called without arguments when the status is finished, either way
+        (including on timeout)
+    """
+    # Check at least this often (s): the readback only posts changes.
+    POLL = 1
+    # Print the progress at most this often (s).
+    REPORT_EVERY = 30
+
+    def __init__(self, device, readback, target, *, tolerance, window,
+                 max_drift, timeout=None, on_done=None):
+        self.device = device
+        self.readback = readback
+        self.target = target
+        self.tolerance = tolerance
+        self.window = window
+        self.max_drift = max_drift
+        self.on_done = on_done
+        self.readings = deque()
+        self.drift = None
+        self.eta = None
+        self.started = self._last_report = ttime.time()
+        self.status = DeviceStatus(device, timeout=timeout)
+        self._lock = threading.Lock()
+        self.status.add_callback(self._cleanup)
+        readback.subscribe(self._update, event_type=readback.SUB_VALUE,
+                           run=True)
+        threading.Thread(target=self._poll, daemon=True).start()
+
+    def _update(self, value, **kwargs):
+        with self._lock:
+            self.readings.append((ttime.time(), value))
+        self._check()
+
+    def _poll(self):
+        while not self.status.done:
+            ttime.sleep(self.POLL)
+            if not self.status.done:
+                self._update(self.readback.get())
+
+    def _check(self):
+        with self._lock:
+            if self.status.done:
+                return
+            now = ttime.time()
+            # keep one reading from before the window: the value at its start
+            while (len(self.readings) > 1 and
+                   self.readings[1][0] <= now - self.window):
+                self.readings.popleft()
+            times, temps = np.array(self.readings, dtype=float).T
+            off = np.abs(temps - self.target) > self.tolerance
+            if times[-1] > times[0]:
+                self.drift = np.polyfit(times - now, temps, 1)[0]
+            # the reading from before the window only marks its start
+            settled = (now - times[0] >= self.window and
+                       not off[1:].any() and not off[-1] and
+                       self.drift is not None and
+                       abs(self.drift) <= self.max_drift)
+            self.eta = self._estimate(now, times, temps, off)
+        if settled:
+            self._finish(True)
+        elif now - self._last_report >= self.REPORT_EVERY:
+            self._last_report = now
+            print(self.progress())
+
+    def _estimate(self, now, times, temps, off):
+        error = self.target - temps[-1]
+        if not off[-1]:
+            # in tolerance since the reading after the last one out of it
+            since = times[np.flatnonzero(off)[-1] + 1] if off.any() else times[0]
+            return max(self.window - (now - since), 0)
+        if self.drift is not None and self.drift * error > 0:
+            return abs(error) / abs(self.drift) + self.window
+        return None
+
+    def progress(self):
+        "One line report of the temperature, drift and time left."
+        value = self.readings[-1][1] if self.readings else float('nan')
+        drift = ('?' if self.drift is None
+                 else '{:+.2f}/min'.format(60 * self.drift))
+        eta = '?' if self.eta is None else '{:.0f} s'.format(self.eta)
+        return ('{}: {:.2f} (target {}), drift {}, settled in {}'
+                .format(self.device.name, value, self.target, drift, eta))
+
+    def _finish(self, success):
+        with self._lock:
+            if self.status.done:
+                return
+            self.status._finished(success=success)
+
+    def _cleanup(self, *args, **kwargs):
+        # however the status was finished, the timeout included
+        self.readback.clear_sub(self._update)
+        if self.on_done is not None:
+            self.on_done()
+
+    def cancel(self, success=False):
+        "Stop following the readback and finish the status."
+        self._finish(success)
+
+
+class ThermalSettleMixin:
+    """
+    Finish ``set`` when the temperature has settled (see ``ThermalSettle``)
+    instead of relying on the controller's own done logic.
+
+    The criteria are attributes, so they can be tuned per device, e.g.
+    ``cs700.settle_window = 60``; ``device.settle`` is the last
+    ``ThermalSettle``, for its ``eta`` and ``progress()``.
+    """
+    settle_tolerance = 1
+    # seconds
+    settle_window = 10
+    # degrees per second
+    settle_max_drift = 1 / 60
+    settle = None
+
+    def settle_readback(self):
+        return self.readback
+
+    def _start_settle(self, target, timeout=None, on_done=None,
+                      setpoint=None):
+        """
+        Follow the readback until it has settled at ``target``. If
+        ``target`` is the ``setpoint`` from before the move there is
+        nothing to settle, and the status is finished right away.
+        """
+        if self.settle is not None:
+            self.settle.cancel()
+        if target == setpoint:
+            if on_done is not None:
+                on_done()
+            return DeviceStatus(self, done=True, success=True)
+        self.settle = ThermalSettle(
+            self, self.settle_readback(), target,
+            tolerance=self.settle_tolerance, window=self.settle_window,
+            max_drift=self.settle_max_drift, timeout=timeout, on_done=on_done)
+        return self.settle.status
+
+    def stop(self, *, success=False):
+        if self.settle is not None:
+            self.settle.cancel(success)
+        super().stop(success=success)
+
+class TemperatureRampMixin:
+    """
+    Ramp the temperature at a fixed rate, see ``ramp``.
+
+    Controllers without a native ramp get one emulated by stepping the
+    setpoint every ``ramp_period`` seconds from a background thread.
+    Must come before ``ThermalSettleMixin`` among the bases.
+    """
+    # seconds between setpoint updates of an emulated ramp
+    ramp_period = 1
+    _ramp_abort = None
+
+    def _put_setpoint(self, value):
+        self.setpoint.put(value)
+
+    def ramp(self, stop, rate, *, timeout=None):
+        """
+        Ramp the temperature to ``stop`` at ``rate`` degrees/min.
+
+        Returns a status finished when the temperature has settled at
+        ``stop`` (see ``ThermalSettle``).
+        """
+        if self._ramp_abort is not None:
+            self._ramp_abort.set()
+        abort = self._ramp_abort = threading.Event()
+        status = DeviceStatus(self, timeout=timeout)
+        start = self.settle_readback().get()
+        step = np.sign(stop - start) * abs(rate) / 60
+
+        def settled(*args, **kwargs):
+            status._finished(success=self.settle.status.success)
+
+        def run():
+            t0 = ttime.time()
+            value = start
+            while value != stop:
+                if abort.wait(self.ramp_period if value != start else 0):
+                    status._finished(success=False)
+                    return
+                value = start + step * (ttime.time() - t0)
+                if (stop - value) * step <= 0:
+                    value = stop
+                self._put_setpoint(value)
+            self._start_settle(stop).add_callback(settled)
+
+        threading.Thread(target=run, daemon=True).start()
+        return status
+
+    def stop(self, *, success=False):
+        if self._ramp_abort is not None:
+            self._ramp_abort.set()
+        super().stop(success=success)
+
+
+
+class CS700TemperatureController(TemperatureRampMixin, ThermalSettleMixin,
+                                 PVPositioner):
     readback = C(EpicsSignalRO, 'T-I')
     setpoint = C(EpicsSignal, 'T-SP')
     done = C(EpicsSignalRO, 'Cmd-Busy')
     stop_signal = C(EpicsSignal, 'Cmd-Cmd')
 
-    def set(self, *args, timeout=None, **kwargs):
-        return super().set(*args, timeout=timeout, **kwargs)
+    def set(self, new_position, *, timeout=None, **kwargs):
+        setpoint = self.setpoint.get()
+        self.setpoint.put(new_position, wait=True)
+        return self._start_settle(new_position, timeout, setpoint=setpoint)
 
     def trigger(self):
         # There is nothing to do. Just report that we are done.
@@ -23,26 +251,42 @@ class CS700TemperatureController(PVPositioner):
         status._finished()
         return status
 
+def _configure_cs700(cs700):
+    cs700.done_value = 0
+    cs700.read_attrs = ['setpoint', 'readback']
+    cs700.readback.name = 'temperature'
+    cs700.setpoint.name = 'temperature_setpoint'
+
 # To allow for sample temperature equilibration time, increase
-# the `settle_time` parameter (units: seconds).
-cs700 = CS700TemperatureController('XF:28IDC-ES:1{Env:01}', name='cs700',
-                                   settle_time=0)
-cs700.done_value = 0
-cs700.read_attrs = ['setpoint', 'readback']
-cs700.readback.name = 'temperature'
-cs700.setpoint.name = 'temperature_setpoint'
+# `cs700.settle_window` (units: seconds).
+cs700 = lazy_device(CS700TemperatureController, 'XF:28IDC-ES:1{Env:01}',
+                    name='cs700', settle_time=0, configure=_configure_cs700)
+
+
+class Eurotherm(TemperatureRampMixin, ThermalSettleMixin,
+                EpicsSignalPositioner):
+    @property
+    def settle_tolerance(self):
+        # the positioner's ``tolerance``, as documented in the README
+        return self.tolerance
 
+    def settle_readback(self):
+        return self
 
-class Eurotherm(EpicsSignalPositioner):
-    def set(self, *args, **kwargs):
-        # override #@!$(#$ hard-coded timeouts
-        return super().set(*args, timeout=1000000, **kwargs)
+    def _put_setpoint(self, value):
+        self.put(value)
 
-eurotherm = Eurotherm('XF:28IDC-ES:1{Env:04}T-I',
-                                 write_pv='XF:28IDC-ES:1{Env:04}T-SP',
-                                 tolerance= 3, name='eurotherm')
+    def set(self, value, *, timeout=None, **kwargs):
+        # no timeout by default (the positioner's is hard-coded)
+        setpoint = self.setpoint
+        self.put(value)
+        return self._start_settle(value, timeout, setpoint=setpoint)
 
-class CryoStat(Device):
+eurotherm = lazy_device(Eurotherm, 'XF:28IDC-ES:1{Env:04}T-I',
+                        write_pv='XF:28IDC-ES:1{Env:04}T-SP',
+                        tolerance= 3, name='eurotherm')
+
+class CryoStat(ThermalSettleMixin, Device):
     # readback
     T = Cpt(EpicsSignalRO, ':IN1')
     # setpoint
@@ -75,44 +319,40 @@ class CryoStat(Device):
         super().__init__(*args, read_attrs=read_attrs,
                          configuration_attrs=configuration_attrs,
                          **kwargs)
-        self._target = None
         self._dead_band = dead_band
-        self._sts = None
-
-    def _sts_mon(self, value, **kwargs):
-        if (self._target is None or
-                 np.abs(self._target - value) < self._dead_band):
-            self.T.clear_sub(self._sts_mon)
-            self.scan.put('Passive', wait=True)
-            if self._sts is not None:
-                self._sts._finished()
-                self._sts = None
-            self._target = None
-
-    def set(self, val):
-        self._target = val
+
+    @property
+    def settle_tolerance(self):
+        return self._dead_band
+
+    def settle_readback(self):
+        return self.T
+
+    def _stop_reading(self):
+        self.scan.put('Passive', wait=True)
+
+    def set(self, val, *, timeout=None):
+        setpoint = self.setpoint.get()
         self.setpoint.put(val, wait=True)
-        sts = self._sts = DeviceStatus(self)
+        # read the temperature continuously while it settles
         self.scan.put('.2 second')
-        self.T.subscribe(self._sts_mon)
-
-        return sts
+        return self._start_settle(val, timeout, on_done=self._stop_reading,
+                                  setpoint=setpoint)
 
     def stop(self, *, success=False):
         self.setpoint.put(self.T.get())
-        if self._sts is not None:
-            self._sts._finished(success=success)
-        self._sts = None
-        self._target = None
-        self.scan.put('Passive', wait=True)
+        if self.settle is not None:
+            self.settle.cancel(success)
+        self._stop_reading()
 
 
-cryostat = CryoStat('XF:28IDC_ES1:LS335:{CryoStat}', name='cryostat', dead_band=1)
+cryostat = lazy_device(CryoStat, 'XF:28IDC_ES1:LS335:{CryoStat}',
+                       name='cryostat', dead_band=1)
 
 
-# TODO : PV needs to be fixed for done signal
-# (doesn't work on ramp down)
-class LinkamFurnace(PVPositioner):
+# The STATUS done signal doesn't work on ramp down, so moves are finished
+# by following the temperature instead.
+class LinkamFurnace(ThermalSettleMixin, PVPositioner):
     readback = C(EpicsSignalRO, 'TEMP')
     setpoint = C(EpicsSignal, 'RAMP:LIMIT:SET')
     done = C(EpicsSignalRO, 'STATUS')
@@ -122,8 +362,20 @@ class LinkamFurnace(PVPositioner):
     def set(self, new_position, *args, timeout=None, **kwargs):
         if abs(new_position - self.setpoint.value) < 1:
             return DeviceStatus(self, done=True, success=True)
-        else:
-            return super().set(new_position, *args, timeout=timeout, **kwargs)
+        self.setpoint.put(new_position, wait=True)
+        return self._start_settle(new_position, timeout)
+
+    def ramp(self, stop, rate, *, timeout=None):
+        """
+        Ramp the temperature to ``stop`` at ``rate`` degrees/min, using the
+        controller's own ramp.
+
+        Returns a status finished when the temperature has settled at
+        ``stop`` (see ``ThermalSettle``).
+        """
+        self.ramp_rate.put(abs(rate), wait=True)
+        self.setpoint.put(stop, wait=True)
+        return self._start_settle(stop, timeout)
 
     def trigger(self):
         # There is nothing to do. Just report that we are done.
@@ -133,13 +385,16 @@ class LinkamFurnace(PVPositioner):
         status._finished()
         return status
 
+def _configure_linkam_furnace(linkam_furnace):
+    linkam_furnace.done_value = 3
+    linkam_furnace.stop_value = 1
+    linkam_furnace.setpoint.kind = "normal"
+    linkam_furnace.readback.kind = "normal"
+    linkam_furnace.readback.name = 'temperature'
+    linkam_furnace.setpoint.name = 'temperature_setpoint'
+
 # To allow for sample temperature equilibration time, increase
-# the `settle_time` parameter (units: seconds).
-linkam_furnace = LinkamFurnace('XF:28IDC-ES:2:{LINKAM}:',
-                               name='linkam_furnace', settle_time=0)
-linkam_furnace.done_value = 3
-linkam_furnace.stop_value = 1
-linkam_furnace.setpoint.kind = "normal"
-linkam_furnace.readback.kind = "normal"
-linkam_furnace.readback.name = 'temperature'
-linkam_furnace.setpoint.name = 'temperature_setpoint'
+# `linkam_furnace.settle_window` (units: seconds).
+linkam_furnace = lazy_device(LinkamFurnace, 'XF:28IDC-ES:2:{LINKAM}:',
+                             name='linkam_furnace', settle_time=0,
+                             configure=_configure_linkam_furnace)
@@ -33,6 +33,6 @@ class RGA(Device):
         return res
  """
 
-rga = RGA('XF:28IDC-VA{RGA:2}',
-          name='rga',
-          read_attrs=['mass1', 'mass2', 'mass3', 'mass4','mass5', 'mass6', 'mass7', 'mass8', 'mass9'])
+rga = lazy_device(RGA, 'XF:28IDC-VA{RGA:2}',
+                  name='rga',
+                  read_attrs=['mass1', 'mass2', 'mass3', 'mass4','mass5', 'mass6', 'mass7', 'mass8', 'mass9'])
@@ -0,0 +1,163 @@
+"Record slow auxiliary PVs (RGA, gas, temperature) as their own event streams"
+
+import threading
+import time as ttime
+from bluesky import Msg
+from bluesky.preprocessors import fly_during_wrapper, plan_mutator
+from ophyd.device import DeviceStatus
+
+
+class MonitorStream:
+    """
+    Flyer recording every update of some signals in its own event stream.
+
+    ``kickoff`` records the current values as a first event and subscribes
+    to the signals, and ``complete`` unsubscribes, so they are followed at
+    their own rate instead of being read (one channel access round trip
+    each) at every detector frame. The stream thus always holds the
+    values at the start, even for a signal that does not change during
+    the run (e.g. the gas, switched before it). Updates arriving less
+    than ``coalesce`` seconds apart are merged into one event holding the
+    latest value and timestamp of each signal: e.g. a sweep of the nine RGA
+    masses becomes a single event. ``collect`` hands over, and forgets, the
+    events buffered so far, so it can be called repeatedly to write them in
+    batches (see ``monitor_streams_wrapper``).
+
+    Parameters
+    ----------
+    name : str
+        name of the event stream
+    signals : list
+        signals, or devices standing for the signals in their read_attrs
+    coalesce : float, optional
+        seconds
+    """
+    def __init__(self, name, signals, coalesce=0.1):
+        self.name = name
+        self.parent = None
+        self.coalesce = coalesce
+        self.signals = []
+        for obj in signals:
+            if hasattr(obj, 'read_attrs'):
+                self.signals.extend(getattr(obj, attr)
+                                    for attr in obj.read_attrs)
+            else:
+                self.signals.append(obj)
+        self._lock = threading.Lock()
+        self._events = []
+        self._latest = {}
+        self._pending_since = None
+
+    def describe_collect(self):
+        desc = {}
+        for sig in self.signals:
+            desc.update(sig.describe())
+        return {self.name: desc}
+
+    def describe_configuration(self):
+        return {}
+
+    def read_configuration(self):
+        return {}
+
+    def kickoff(self):
+        with self._lock:
+            self._pending_since = None
+            for sig in self.signals:
+                for key, reading in sig.read().items():
+                    self._latest[key] = (reading['value'],
+                                         reading['timestamp'])
+            # timed when read, like the events of trigger_and_read
+            self._events = [self._event(ttime.time())]
+        for sig in self.signals:
+            sig.subscribe(self._update, event_type=sig.SUB_VALUE, run=False)
+        return DeviceStatus(self, done=True, success=True)
+
+    def _update(self, value, obj, timestamp=None, **kwargs):
+        now = ttime.time()
+        with self._lock:
+            if (self._pending_since is not None and
+                    now - self._pending_since > self.coalesce):
+                self._flush()
+            self._latest[obj.name] = (value, timestamp or now)
+            if self._pending_since is None:
+                self._pending_since = now
+
+    def _event(self, time):
+        return {'time': time,
+                'data': {key: value for key, (value, _)
+                         in self._latest.items()},
+                'timestamps': {key: ts for key, (_, ts)
+                               in self._latest.items()}}
+
+    def _flush(self):
+        # with the lock held
+        if self._pending_since is None:
+            return
+        self._events.append(self._event(
+            max(ts for _, ts in self._latest.values())))
+        self._pending_since = None
+
+    def complete(self):
+        for sig in self.signals:
+            sig.clear_sub(self._update)
+        return DeviceStatus(self, done=True, success=True)
+
+    def collect(self):
+        with self._lock:
+            self._flush()
+            events, self._events = self._events, []
+        yield from events
+
+    def stop(self, *, success=False):
+        self.complete()
+
+
+def monitor_streams_wrapper(plan, streams, flush_every=10):
+    """
+    Record ``MonitorStream``s during every run of a plan.
+
+    The buffered updates are written out whenever an event has been saved
+    and ``flush_every`` seconds have passed since the last time, and at the
+    end of the run.
+
+    Example
+    -------
+    >>> RE(monitor_streams_wrapper(count([pe1c], 10), [rga_stream()]))
+    """
+    streams = list(streams)
+    last_flush = [ttime.time()]
+
+    def flush():
+        last_flush[0] = ttime.time()
+        for stream in streams:
+            yield Msg('collect', stream)
+
+    def msg_proc(msg):
+        if (msg.command == 'save' and
+                ttime.time() - last_flush[0] > flush_every):
+            return None, flush()
+        return None, None
+
+    return (yield from plan_mutator(fly_during_wrapper(plan, streams),
+                                    msg_proc))
+
+
+# The usual auxiliary streams. These are functions, as the devices are
+# defined in later startup files.
+
+def rga_stream(coalesce=1):
+    "the nine RGA masses, in the 'rga_monitor' stream"
+    return MonitorStream('rga_monitor', [rga], coalesce=coalesce)
+
+
+def gas_stream():
+    "the gas flowing, in the 'gas_monitor' stream"
+    return MonitorStream('gas_monitor', [gas.current_gas])
+
+
+def temperature_stream(*controllers):
+    "temperature readbacks, in the 'temperature_monitor' stream"
+    return MonitorStream('temperature_monitor',
+                         [controller.settle_readback()
+                          for controller in controllers])
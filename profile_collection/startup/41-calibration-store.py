@@ -0,0 +1,143 @@
+"Keep every energy calibration in a local SQLite database, and look them up by time"
+
+import contextlib
+import os
+import sqlite3
+import time as ttime
+from collections import namedtuple
+
+import numpy as np
+
+
+Calibration = namedtuple('Calibration', [
+    'time', 'wavelength', 'wavelength_std', 'theta_offset',
+    'theta_offset_std', 'reference', 'method', 'uids'])
+
+
+class CalibrationStore:
+    """
+    Energy calibration results, kept in a SQLite database.
+
+    Each calibration is valid from its ``time`` until the next one. The
+    table is indexed on time, so ``at`` finds the one valid at any
+    timestamp in O(log n). ``at_many`` looks up many timestamps in one
+    query. Use it to annotate thousands of runs without refitting anything.
+
+    Parameters
+    ----------
+    path : str
+        the database file, created if needed
+
+    Example
+    -------
+    >>> calibration_store.at(db[-1].start['time']).wavelength
+    >>> calibration_store.at_many([h.start['time'] for h in db(plan_name='count')])
+    """
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS calibrations ('
+                         'time REAL NOT NULL, wavelength REAL NOT NULL, '
+                         'wavelength_std REAL, theta_offset REAL, '
+                         'theta_offset_std REAL, reference TEXT, '
+                         'method TEXT, uids TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS calibrations_time '
+                         'ON calibrations (time)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one connection per call: results come from the RunEngine's
+        # callbacks as well as from the shell
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _calibration(row):
+        row = list(row)
+        row[-1] = row[-1].split() if row[-1] else []
+        return Calibration(*row)
+
+    def record(self, wavelength, wavelength_std=None, theta_offset=None,
+               theta_offset_std=None, reference=None, method=None, uids=(),
+               time=None):
+        """
+        Add a calibration.
+
+        Parameters
+        ----------
+        wavelength, wavelength_std : float
+            in angstroms
+        theta_offset, theta_offset_std : float, optional
+            in the units of the calibration motor
+        reference : str, optional
+            the standard, e.g. 'Si'
+        method : str, optional
+            the plan or callback that made it
+        uids : list of str, optional
+            the runs it was fit to
+        time : float, optional
+            from when it is valid, defaults to now
+
+        Returns
+        -------
+        calibration : Calibration
+        """
+        calibration = Calibration(
+            ttime.time() if time is None else float(time), float(wavelength),
+            *(None if v is None else float(v)
+              for v in (wavelength_std, theta_offset, theta_offset_std)),
+            reference, method, list(uids))
+        row = calibration[:-1] + (' '.join(calibration.uids),)
+        with self._connect() as conn:
+            conn.execute('INSERT INTO calibrations VALUES (?, ?, ?, ?, ?, ?, '
+                         '?, ?)', row)
+        return calibration
+
+    def at(self, timestamp):
+        """
+        The calibration valid at a timestamp, or None if there was none yet.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM calibrations WHERE time <= ? '
+                               'ORDER BY time DESC LIMIT 1',
+                               (timestamp,)).fetchone()
+        return None if row is None else self._calibration(row)
+
+    def latest(self):
+        """ the calibration valid now """
+        return self.at(float('inf'))
+
+    def at_many(self, timestamps):
+        """
+        The calibrations valid at each of many timestamps.
+
+        This reads the table once and bisects it, so it costs one query
+        plus O(log n) per timestamp.
+
+        Returns
+        -------
+        calibrations : list of Calibration or None
+        """
+        rows = self.history()
+        times = np.array([row.time for row in rows])
+        idx = np.searchsorted(times, np.asarray(timestamps, dtype=float),
+                              side='right') - 1
+        return [rows[i] if i >= 0 else None for i in idx]
+
+    def history(self, since=None, until=None):
+        """ the calibrations made between two timestamps, oldest first """
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT * FROM calibrations WHERE time >= ? AND time <= ? '
+                'ORDER BY time',
+                (-np.inf if since is None else since,
+                 np.inf if until is None else until)).fetchall()
+        return [self._calibration(row) for row in rows]
+
+
+calibration_store = CalibrationStore(
+    os.path.join(get_ipython().profile_dir.location, 'calibrations.sqlite'))
@@ -1,7 +1,13 @@
 from __future__ import division, print_function
+import contextlib
+import io
+import os
+import time
 import numpy as np
 from lmfit.models import VoigtModel, LinearModel
+from scipy.optimize import least_squares
 from scipy.signal import argrelmax
+from scipy.special import wofz
 import matplotlib.pyplot as plt
 
 
@@ -10,33 +16,67 @@ def lamda_from_bragg(th, d, n):
 
 
 def find_peaks(chi, sides=6, intensity_threshold=0):
-    # Find all potential peaks
-    preliminary_peaks = argrelmax(chi, order=20)[0]
+    """
+    Find the peaks of a curve in one vectorized pass.
 
-    # peaks must have at least sides pixels of data to work with
-    preliminary_peaks2 = preliminary_peaks[
-        np.where(preliminary_peaks < len(chi) - sides)]
+    A peak is a local maximum (over 20 points on either side) at least
+    ``sides`` points from the ends, more than twice as high as the curve
+    ``sides`` points away on both sides and at least
+    ``intensity_threshold`` high.
 
-    # make certain that a peak has a drop off which causes the peak height to
-    # be more than twice the height at sides pixels away
-    criteria = chi[preliminary_peaks2] >= 2 * chi[preliminary_peaks2 + sides]
-    criteria *= chi[preliminary_peaks2] >= 2 * chi[preliminary_peaks2 - sides]
-    criteria *= chi[preliminary_peaks2] >= intensity_threshold
+    Returns
+    -------
+    left_idxs, right_idxs, peak_centers : ndarray
+        the window ``[left, right)`` of ``sides`` points on each side of
+        every peak, and the peak indices
+    """
+    chi = np.asarray(chi)
+    peaks = argrelmax(chi, order=20)[0]
+    peaks = peaks[(peaks >= sides) & (peaks < len(chi) - sides)]
+    height = chi[peaks]
+    criteria = ((height >= 2 * chi[peaks + sides]) &
+                (height >= 2 * chi[peaks - sides]) &
+                (height >= intensity_threshold))
+    peaks = peaks[criteria]
+    return peaks - sides, peaks + sides, peaks
 
-    peaks = preliminary_peaks[np.where(criteria)]
 
-    left_idxs = peaks - sides
-    right_idxs = peaks + sides
-    peak_centers = peaks
-    left_idxs[left_idxs < 0] = 0
-    right_idxs[right_idxs > len(chi)] = len(chi)
-    return left_idxs, right_idxs, peak_centers
+def _voigt(x, centers, sigma):
+    """
+    Voigt profiles of unit area with gamma = sigma (as lmfit's VoigtModel),
+    with their derivatives with respect to the center and sigma.
 
+    Returns three arrays of shape (len(centers), len(x)).
+    """
+    s2 = sigma * np.sqrt(2)
+    z = (x[np.newaxis, :] - centers[:, np.newaxis] + 1j * sigma) / s2
+    w = wofz(z)
+    # derivative of the Faddeeva function
+    dw = -2 * z * w + 2j / np.sqrt(np.pi)
+    norm = 1 / (sigma * np.sqrt(2 * np.pi))
+    profile = norm * w.real
+    d_center = -norm * dw.real / s2
+    d_sigma = (norm * (dw * (1j / np.sqrt(2) - z)).real - profile) / sigma
+    return profile, d_center, d_sigma
 
-def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False):
+
+def _tth_from_wavelength(wavelength, d, n):
+    "two theta (degrees) of reflections, and its derivative by wavelength"
+    s = n * wavelength / (2 * d)
+    tth = 2 * np.rad2deg(np.arcsin(s))
+    return tth, 2 * np.rad2deg(1) * n / (2 * d) / np.sqrt(1 - s**2)
+
+
+def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False, sides=12):
     """
     Return the wavelength from a two theta scan of a standard
 
+    All the peaks are fit at once, on both sides of zero, with one model:
+    a Voigt per peak, centered at +/- the two theta of its reflection for
+    a shared wavelength, plus a shared zero offset, a shared width and a
+    linear background around each peak. The fit uses the analytic
+    Jacobian of the model.
+
     Parameters
     ----------
     x: ndarray
@@ -49,12 +89,118 @@ def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False):
         the multiplicity of the reflection
     plot: bool
         If true plot some of the intermediate data
+    sides: int
+        number of points on each side of a peak to fit
+    Returns
+    -------
+    float:
+        The wavelength
+    float:
+        Its standard error, from the fit
+    float:
+        The offset to add to ``x`` to center the peaks on zero
+    """
+    order = np.argsort(x)
+    x = np.asarray(x, dtype=float)[order]
+    y = np.asarray(y, dtype=float)[order]
+    d_spacings = np.asarray(d_spacings, dtype=float)
+    ns = np.asarray(ns, dtype=float)
+
+    # Pair the peaks from the inside out with the reflections, the
+    # innermost pair with the largest d spacing.
+    l, r, c = find_peaks(y, sides=sides)
+    n_pairs = min(len(c) // 2, len(d_spacings))
+    if n_pairs == 0:
+        raise ValueError("No symmetric pair of peaks found")
+    left = c[len(c) // 2 - n_pairs:len(c) // 2][::-1]
+    right = c[len(c) - len(c) // 2:][:n_pairs]
+    d, n = d_spacings[:n_pairs], ns[:n_pairs]
+    peaks = np.concatenate([left, right])
+    sign = np.repeat([-1., 1.], n_pairs)
+    reflection = np.tile(np.arange(n_pairs), 2)
+
+    # initial guesses
+    shift = np.median((x[left] + x[right]) / 2)
+    wavelength = np.median(lamda_from_bragg(
+        np.deg2rad((x[right] - x[left]) / 2), d, n))
+    windows = [np.arange(max(p - sides, 0), min(p + sides, len(x)))
+               for p in peaks]
+    idx = np.concatenate(windows)
+    window = np.repeat(np.arange(len(peaks)), [len(w) for w in windows])
+    xs, ys = x[idx], y[idx]
+    dxs = xs - x[peaks][window]
+    base = np.array([y[w].min() for w in windows])
+    height = y[peaks] - base
+    half_width = np.median([np.sum(y[w] - b > h / 2)
+                            for w, b, h in zip(windows, base, height)])
+    sigma = max(half_width, 1) * np.median(np.diff(x)) / 3.6
+    amplitude = height / _voigt(np.zeros(1), np.zeros(1), sigma)[0][0, 0]
+    n_peaks = len(peaks)
+    p0 = np.concatenate([[wavelength, shift, sigma], amplitude, base,
+                         np.zeros(n_peaks)])
+
+    def unpack(p):
+        return (p[0], p[1], p[2], p[3:3 + n_peaks],
+                p[3 + n_peaks:3 + 2 * n_peaks], p[3 + 2 * n_peaks:])
+
+    def profiles(p):
+        wavelength, shift, sigma, amplitude, b0, b1 = unpack(p)
+        tth, dtth = _tth_from_wavelength(wavelength, d, n)
+        centers = sign * tth[reflection] + shift
+        profile, d_center, d_sigma = _voigt(xs, centers, sigma)
+        return tth, dtth, amplitude, b0, b1, profile, d_center, d_sigma
+
+    def residuals(p):
+        _, _, amplitude, b0, b1, profile, _, _ = profiles(p)
+        return amplitude @ profile + b0[window] + b1[window] * dxs - ys
+
+    def jacobian(p):
+        _, dtth, amplitude, _, _, profile, d_center, d_sigma = profiles(p)
+        jac = np.zeros((len(xs), len(p)))
+        weighted = amplitude[:, np.newaxis] * d_center
+        jac[:, 0] = (sign * dtth[reflection]) @ weighted
+        jac[:, 1] = weighted.sum(axis=0)
+        jac[:, 2] = amplitude @ d_sigma
+        jac[:, 3:3 + n_peaks] = profile.T
+        rows = np.arange(len(xs))
+        jac[rows, 3 + n_peaks + window] = 1
+        jac[rows, 3 + 2 * n_peaks + window] = dxs
+        return jac
+
+    with np.errstate(invalid='ignore'):
+        result = least_squares(residuals, p0, jac=jacobian, method='lm')
+    wavelength, shift = result.x[:2]
+    dof = max(len(xs) - len(p0), 1)
+    cov = np.linalg.pinv(result.jac.T @ result.jac) * 2 * result.cost / dof
+    wavelength_std = np.sqrt(cov[0, 0])
+
+    if plot:
+        plt.plot(x, y, 'b')
+        plt.plot(x[peaks], y[peaks], 'ro')
+        fit = residuals(result.x) + ys
+        for w in range(n_peaks):
+            plt.plot(xs[window == w], fit[window == w], '--')
+        plt.show()
+    print('predicted offset {}'.format(-shift))
+    return wavelength, wavelength_std, -shift
+
+
+def get_wavelength_from_std_tth_lmfit(x, y, d_spacings, ns, plot=False):
+    """
+    Return the wavelength from a two theta scan of a standard, fitting each
+    peak separately with lmfit
+
+    This was ``get_wavelength_from_std_tth`` before the joint fit; it is
+    kept for comparison (see ``benchmark_wavelength_fit``).
+
     Returns
     -------
     float:
-        The average wavelength
+        The average wavelength over the peaks
+    float:
+        The standard deviation of the wavelength over the peaks
     float:
-        The standard deviation of the wavelength
+        The offset to add to ``x`` to center the peaks on zero
     """
     l, r, c = find_peaks(y, sides=12)
     n_sym_peaks = len(c)//2
@@ -97,6 +243,51 @@ def get_wavelength_from_std_tth(x, y, d_spacings, ns, plot=False):
             wavelengths.append(lamda_from_bragg(tth, d, n))
     return np.average(wavelengths), np.std(wavelengths), np.median(offset)
 
+# the LaB6 reference scans and d spacings at the top of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', '..', 'data')
+
+
+def benchmark_wavelength_fit(data_files=('Lab6_67p6.chi', 'Lab6_67p8.chi'),
+                             repeat=20, seed=0):
+    """
+    Compare the speed and precision of ``get_wavelength_from_std_tth`` and
+    ``get_wavelength_from_std_tth_lmfit`` on the reference scans in data/.
+
+    Each one sided .chi pattern is mirrored into a symmetric scan, shifted
+    by a random offset (up to 1 degree) and given Poisson noise, ``repeat``
+    times; the spread of the wavelengths found measures the precision.
+
+    Returns
+    -------
+    results : dict
+        {(file, method): (seconds per fit, mean wavelength, spread)}
+    """
+    d_spacings = np.loadtxt(os.path.join(DATA_DIR, 'LaB6_d.txt'))
+    ns = np.ones(d_spacings.shape)
+    rng = np.random.RandomState(seed)
+    results = {}
+    for data_file in data_files:
+        a = np.loadtxt(os.path.join(DATA_DIR, data_file))
+        x = np.hstack((-a[::-1, 0], a[:, 0]))
+        y = np.hstack((a[::-1, 1], a[:, 1]))
+        scans = [(x + rng.uniform(-1, 1), rng.poisson(y).astype(float))
+                 for _ in range(repeat)]
+        for method in (get_wavelength_from_std_tth,
+                       get_wavelength_from_std_tth_lmfit):
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                wavelengths = [method(xs, ys, d_spacings, ns)[0]
+                               for xs, ys in scans]
+            elapsed = (time.perf_counter() - t0) / repeat
+            results[data_file, method.__name__] = (
+                elapsed, np.mean(wavelengths), np.std(wavelengths))
+            print('{:<16} {:<36} {:8.1f} ms  {:.6f} +- {:.1e} A'.format(
+                data_file, method.__name__, elapsed * 1e3,
+                np.mean(wavelengths), np.std(wavelengths)))
+    return results
+
+
 
 from bluesky.callbacks import CollectThenCompute
 
@@ -107,14 +298,20 @@ class ComputeWavelength(CollectThenCompute):
     -------
     >>> cw = ComputeWavelgnth('tth_cal', 'some_detector', d_spacings, ns)
     >>> RE(scan(...), cw)
+
+    Every result is recorded in ``store`` (``calibration_store`` by
+    default, None not to), labelled with ``reference``.
     """
     CONVERSION_FACTOR = 12.3984  # keV-Angstroms
-    def __init__(self, x_name, y_name, d_spacings, ns=None):
+    def __init__(self, x_name, y_name, d_spacings, ns=None, reference=None,
+                 store=calibration_store):
         self._descriptors = []
         self._events = []
         self.x_name = x_name
         self.y_name = y_name
         self.d_spacings = d_spacings
+        self.reference = reference
+        self.store = store
         self.wavelength = None
         self.wavelength_std = None
         self.offset = None
@@ -142,6 +339,12 @@ class ComputeWavelength(CollectThenCompute):
         self.wavelength, self.wavelength_std, self.offset = get_wavelength_from_std_tth(x, y, self.d_spacings, self.ns)
         print('wavelength', self.wavelength, '+-', self.wavelength_std)
         print('energy', self.energy)
+        if self.store is not None:
+            start = getattr(self, '_start_doc', None)
+            self.store.record(self.wavelength, self.wavelength_std,
+                              self.offset, reference=self.reference,
+                              method=type(self).__name__,
+                              uids=[start['uid']] if start else [])
 
 """
 if __name__ == '__main__':
@@ -0,0 +1,48 @@
+"Read areaDetector HDF5 files while they are still being written (SWMR)"
+
+# The analysis profile runs this file too, see
+# profile_analysis/startup/01-hdf5-swmr-handler.py.
+
+import h5py
+
+
+class AreaDetectorHDF5SWMRHandler:
+    """
+    Handler for the 'AD_HDF5_SWMR' spec: the HDF5 files of XPDHDF5Plugin.
+
+    The file is opened in SWMR (single writer, multiple readers) mode, and
+    the dataset refreshed whenever a point beyond its known length is asked
+    for, so frames can be read back while the run is still acquiring.
+
+    Parameters
+    ----------
+    filename : str
+    frame_per_point : int, optional
+    """
+    specs = {'AD_HDF5_SWMR'}
+
+    def __init__(self, filename, frame_per_point=1):
+        self._filename = filename
+        self._frame_per_point = frame_per_point
+        self._file = h5py.File(filename, 'r', swmr=True)
+        self._dataset = self._file['entry/data/data']
+
+    def __call__(self, point_number):
+        start = point_number * self._frame_per_point
+        stop = start + self._frame_per_point
+        if stop > self._dataset.shape[0]:
+            self._dataset.refresh()
+        if stop > self._dataset.shape[0]:
+            raise IOError("Point {} is not in {} yet".format(point_number,
+                                                             self._filename))
+        return self._dataset[start:stop].squeeze()
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [self._filename]
+
+    def close(self):
+        self._file.close()
+
+
+db.reg.register_handler('AD_HDF5_SWMR', AreaDetectorHDF5SWMRHandler,
+                        overwrite=True)
@@ -1,9 +1,12 @@
+import threading
 import time as ttime
+from collections import namedtuple
 from copy import deepcopy
 from ophyd.areadetector import (PerkinElmerDetector, ImagePlugin,
                                 TIFFPlugin, StatsPlugin, HDF5Plugin,
                                 ProcessPlugin, ROIPlugin)
 from ophyd.device import BlueskyInterface
+from ophyd.areadetector.plugins import HDF5Plugin_V25
 from ophyd.areadetector.trigger_mixins import SingleTrigger, MultiTrigger
 from ophyd.areadetector.filestore_mixins import (FileStoreIterativeWrite,
                                                  FileStoreHDF5IterativeWrite,
@@ -12,6 +15,10 @@ from ophyd.areadetector.filestore_mixins import (FileStoreIterativeWrite,
 from ophyd import Signal, EpicsSignal, EpicsSignalRO # Tim test
 from ophyd import Component as C
 from ophyd import StatusBase
+from ophyd.device import Staged
+from ophyd.status import wait as status_wait
+from bluesky.plans import count
+from bluesky.preprocessors import plan_mutator
 
 
 # monkey patch for trailing slash problem
@@ -35,7 +42,7 @@ ophyd.areadetector.filestore_mixins._ensure_trailing_slash = _ensure_trailing_sl
 # from shutter import sh1
 
 #shctl1 = EpicsSignal('XF:28IDC-ES:1{Det:PE1}cam1:ShutterMode', name='shctl1')
-shctl1 = EpicsMotor('XF:28IDC-ES:1{Sh2:Exp-Ax:5}Mtr', name='shctl1')
+shctl1 = lazy_device(EpicsMotor, 'XF:28IDC-ES:1{Sh2:Exp-Ax:5}Mtr', name='shctl1')
 
 
 
@@ -108,24 +115,207 @@ class SavedImageSignal(Signal):
         return ret
 
 
-def take_dark(cam, light_field, dark_field_name):
-    # close shutter
+# the reading and description of the dark, as from read() and describe()
+DarkFrame = namedtuple('DarkFrame', ['uid', 'time', 'reading', 'description'])
 
-    # take the dark frame
-    cam.stage()
-    st = cam.trigger()
-    while not st.done:
-        ttime.sleep(.1)
-    ret = cam.read()
-    desc = cam.describe()
-    cam.unstage()
+
+class DarkFrameCache:
+    """
+    The last dark frame of each detector configuration.
+
+    A dark is keyed on the detector name, acquire time, images per set,
+    gain and binning, so changing any of them calls for a new one, and is
+    only reused for ``max_age`` seconds. The cache also remembers which
+    dark was last loaded as the background of each detector's ProcessPlugin
+    (see ``ProcDarkSubtraction``), as that is shared by all configurations.
+
+    Parameters
+    ----------
+    max_age : float, optional
+        seconds
+    """
+    def __init__(self, max_age=30 * 60):
+        self.max_age = max_age
+        self._darks = {}
+        # detector name -> uid of the dark loaded in its proc
+        self._backgrounds = {}
+
+    @staticmethod
+    def key(det):
+        cam = det.cam
+        config = [getattr(cam, attr).get()
+                  for attr in ('pe_gain', 'bin_x', 'bin_y')
+                  if hasattr(cam, attr)]
+        return (det.name, cam.acquire_time.get(), det.images_per_set.get(),
+                tuple(config))
+
+    def get(self, det, max_age=None):
+        "the valid dark of a detector, or None"
+        dark = self._darks.get(self.key(det))
+        if max_age is None:
+            max_age = self.max_age
+        if dark is None or ttime.time() - dark.time > max_age:
+            return None
+        return dark
+
+    def put(self, det, uid, reading, description, background=False):
+        """
+        Cache a dark; ``background`` tells it was also loaded in ``proc``.
+        """
+        dark = DarkFrame(uid, ttime.time(), reading, description)
+        self._darks[self.key(det)] = dark
+        if background:
+            self._backgrounds[det.name] = uid
+        return dark
+
+    def has_background(self, det, max_age=None):
+        "whether the valid dark of a detector is the one loaded in its proc"
+        dark = self.get(det, max_age)
+        return (dark is not None and dark.uid is not None and
+                self._backgrounds.get(det.name) == dark.uid)
+
+    def clear(self, det=None):
+        "forget the darks, of one detector or of all"
+        if det is None:
+            self._darks.clear()
+            return
+        for key in [key for key in self._darks if key[0] == det.name]:
+            del self._darks[key]
+
+
+dark_frame_cache = DarkFrameCache()
+
+
+def take_dark(cam, light_field, dark_field_name, max_age=None):
+    """
+    Put a dark frame of ``cam`` in its ``dark_field_name`` signal.
+
+    A valid dark from ``dark_frame_cache`` is reused, otherwise one is taken
+    (with the shutter closed by the caller) and cached.
+    """
+    dark = dark_frame_cache.get(cam, max_age)
+    if dark is None or light_field not in dark.reading:
+        # take the dark frame
+        cam.stage()
+        try:
+            status_wait(cam.trigger())
+            ret = cam.read()
+            desc = cam.describe()
+        finally:
+            cam.unstage()
+        dark = dark_frame_cache.put(cam, None, ret, desc)
 
     # save the df uid
-    df = ret[light_field]
     df_sig = getattr(cam, dark_field_name)
-    df_sig.put(**df)
+    df_sig.put(**dark.reading[light_field])
     # save the darkfrom description
-    df_sig.stashed_datakey = desc[light_field]
+    df_sig.stashed_datakey = dark.description[light_field]
+
+
+def dark_frame_plan(det, shutter=shctl1, md=None):
+    """
+    Take a dark frame of ``det``, in a run of its own, and cache it.
+
+    The shutter is closed (0) for the dark and opened (1) after, as in the
+    ``trigger_cycle`` of the PerkinElmerMulti detectors. If the detector
+    subtracts the dark itself (see ``ProcDarkSubtraction``), the dark is
+    also loaded as the background of its ProcessPlugin.
+
+    Returns
+    -------
+    uid : str
+        of the dark run
+    """
+    _md = {'plan_name': 'dark_frame_plan', 'dark_frame': True,
+           'detectors': [det.name]}
+    _md.update(md or {})
+    # the detector may already be staged by the plan calling for the dark
+    staged = det._staged == Staged.yes
+    subtract = bool(getattr(det, 'subtract_dark', None) and
+                    det.subtract_dark.get())
+    yield from bps.mv(shutter, 0)
+    uid = yield from bps.open_run(md=_md)
+    if not staged:
+        det._loading_background = subtract
+        try:
+            yield from bps.stage(det)
+        finally:
+            det._loading_background = False
+    if subtract:
+        # the dark itself is saved raw
+        yield from bps.mv(det.proc.enable_background, 0)
+    reading = yield from bps.trigger_and_read([det])
+    if subtract:
+        # the last output of proc is the dark frames averaged by the
+        # tiff squashing, i.e. the dark of a single frame
+        yield from bps.mv(det.proc.save_background, 1)
+        yield from bps.mv(det.proc.enable_background, 1)
+    if not staged:
+        yield from bps.unstage(det)
+    yield from bps.close_run()
+    yield from bps.mv(shutter, 1)
+    dark_frame_cache.put(det, uid, reading, det.describe(),
+                         background=subtract)
+    return uid
+
+
+def dark_frame_wrapper(plan, detectors, max_age=None, shutter=shctl1):
+    """
+    Give every run of a plan a dark frame of each detector.
+
+    Before each run, a dark is taken (see ``dark_frame_plan``) for the
+    detectors without a valid one in ``dark_frame_cache``, or, if they
+    subtract it, whose valid one is not the background loaded in their
+    ProcessPlugin; and before they are staged if they are staged first.
+    The uids of the darks are recorded
+    in the start document, as ``dark_frame_uids`` ({detector name: uid}),
+    and the detectors subtracting them in the IOC as ``dark_subtracted``.
+
+    Example
+    -------
+    >>> RE(dark_frame_wrapper(count([pe2], 10), [pe2]))
+    """
+    # plan_mutator passes the messages of the darks (and the amended
+    # open_run) to msg_proc as well
+    taking_darks = [False]
+
+    def add_darks(msg):
+        taking_darks[0] = True
+        try:
+            uids = {}
+            for det in detectors:
+                dark = dark_frame_cache.get(det, max_age)
+                subtract = bool(getattr(det, 'subtract_dark', None) and
+                                det.subtract_dark.get())
+                if (dark is None or dark.uid is None or
+                        (subtract and
+                         not dark_frame_cache.has_background(det, max_age))):
+                    uid = yield from dark_frame_plan(det, shutter)
+                else:
+                    uid = dark.uid
+                uids[det.name] = uid
+            if msg.command == 'open_run':
+                kwargs = dict(msg.kwargs)
+                kwargs['dark_frame_uids'] = uids
+                kwargs['dark_subtracted'] = [
+                    det.name for det in detectors
+                    if getattr(det, 'subtract_dark', None) and
+                    det.subtract_dark.get()]
+                msg = msg._replace(kwargs=kwargs)
+            return (yield msg)
+        finally:
+            taking_darks[0] = False
+
+    def msg_proc(msg):
+        if taking_darks[0]:
+            return None, None
+        if (msg.command == 'open_run' or
+                (msg.command == 'stage' and
+                 any(msg.obj is det for det in detectors))):
+            return add_darks(msg), None
+        return None, None
+
+    return (yield from plan_mutator(plan, msg_proc))
 
 
 class XPDTIFFPlugin(TIFFPlugin, FileStoreTIFFSquashing,
@@ -133,35 +323,94 @@ class XPDTIFFPlugin(TIFFPlugin, FileStoreTIFFSquashing,
     pass
 
 
-class XPDHDF5Plugin(HDF5Plugin, FileStoreHDF5IterativeWrite):
-    pass
+class XPDHDF5Plugin(HDF5Plugin_V25, FileStoreHDF5IterativeWrite):
+    """
+    Write a run in a single HDF5 file, in SWMR mode, one chunk per frame.
+
+    Frames are flushed as they are written, so they can be read (with the
+    AD_HDF5_SWMR handler) while the run goes on; SWMR needs ADCore 2.5 or
+    later, hence HDF5Plugin_V25. The detector configures the
+    chunks and the averaging of each set of frames, see
+    ``XPDPerkinElmerHDF5``.
+
+    Parameters
+    ----------
+    compression : str, optional
+        one of the HDF5 plugin's: 'None', 'N-bit', 'szip', 'zlib', 'blosc',
+        'bslz4', 'lz4'
+    """
+    def __init__(self, *args, compression='None', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filestore_spec = 'AD_HDF5_SWMR'
+        self.stage_sigs.update([('compression', compression),
+                                ('swmr_mode', 'On'),
+                                ('num_frames_flush', 1),
+                                ('num_frames_chunks', 1),
+                                ('num_capture', 0),
+                                ])
+
+    # set by PerkinElmerStream, which makes a point of every frame
+    streaming = False
+
+    def get_frames_per_point(self):
+        # one (averaged) frame per set
+        if self.streaming:
+            return 1
+        return self.parent.number_of_sets.get()
 
 
-class XPDPerkinElmer(PerkinElmerDetector):
+class ProcDarkSubtraction(BlueskyInterface):
+    """
+    Subtract the dark frame in the IOC, in the ProcessPlugin ``proc``.
+
+    While ``subtract_dark`` is set, the background of ``proc`` is subtracted
+    from every frame before the frames are summed and written, so the files
+    hold dark subtracted images and Python never has to. The background is
+    loaded by ``dark_frame_plan`` (and so ``dark_frame_wrapper``) and is
+    only valid for the detector configuration it was taken with, see
+    ``dark_frame_cache``. The output is Float32 so no negative value is
+    clipped.
+
+    Expects ``cam``, ``proc`` and ``subtract_dark`` components.
+    """
+    _loading_background = False
+
+    def _dark_stage_sigs(self):
+        "the settings of proc for the current subtract_dark"
+        if not self.subtract_dark.get():
+            self.proc.stage_sigs.pop('data_type_out', None)
+            return [('enable_background', 0)]
+        if (not self._loading_background and
+                not dark_frame_cache.has_background(self)):
+            print("Warning: the background of {} is not a valid dark frame "
+                  "for its current settings, frames are corrected by a "
+                  "wrong one. Run the plan through dark_frame_wrapper."
+                  .format(self.name))
+        return [('enable_background', 1), ('data_type_out', 'Float32')]
+
+    def stage(self):
+        self.proc.stage_sigs.update(self._dark_stage_sigs())
+        return super().stage()
+
+
+class XPDPerkinElmerBase(ProcDarkSubtraction, PerkinElmerDetector):
+    """
+    The PerkinElmer detectors, less their file writer and ``proc`` (which
+    must be staged after the writer): see XPDPerkinElmer and
+    XPDPerkinElmerHDF5.
+    """
     image = C(ImagePlugin, 'image1:')
     _default_configuration_attrs = (
         PerkinElmerDetector._default_configuration_attrs +
-        ('images_per_set', 'number_of_sets'))
-    tiff = C(XPDTIFFPlugin, 'TIFF1:',
-             write_path_template='/a/b/c/',
-             read_path_template='/a/b/c',
-             cam_name='cam',  # used to configure "tiff squashing"
-             proc_name='proc',  # ditto
-             read_attrs=[],
-             root='/nsls2/xf28id2/')
-
-    # hdf5 = C(XPDHDF5Plugin, 'HDF1:',
-    #          write_path_template='G:/pe1_data/%Y/%m/%d/',
-    #          read_path_template='/direct/XF28ID2/pe1_data/%Y/%m/%d/',
-    #          root='/direct/XF28ID2/')
-
-    proc = C(ProcessPlugin, 'Proc1:')
+        ('images_per_set', 'number_of_sets', 'subtract_dark'))
 
     # These attributes together replace `num_images`. They control
     # summing images before they are stored by the detector (a.k.a. "tiff
     # squashing").
     images_per_set = C(Signal, value=1, add_prefix=())
     number_of_sets = C(Signal, value=1, add_prefix=())
+    # subtract the dark in proc, see ProcDarkSubtraction
+    subtract_dark = C(Signal, value=0, add_prefix=())
 
     stats1 = C(StatsPlugin, 'Stats1:')
     stats2 = C(StatsPlugin, 'Stats2:')
@@ -176,10 +425,167 @@ class XPDPerkinElmer(PerkinElmerDetector):
 
     # dark_image = C(SavedImageSignal, None)
 
+    # reduced_readout values -> StatsPlugin signals
+    REDUCED_VALUES = {'total': ['total'],
+                      'mean': ['mean_value'],
+                      'std': ['sigma'],
+                      'min': ['min_value'],
+                      'max': ['max_value'],
+                      'centroid': ['centroid.x', 'centroid.y'],
+                      'sigma': ['sigma_x', 'sigma_y']}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.stage_sigs.update([(self.cam.trigger_mode, 'Internal')])
 
+    def reduced_readout(self, rois=(), values=('total',)):
+        """
+        Read statistics of every frame as scalars, along with the image.
+
+        The frames written (the output of ``proc``: averaged per set, dark
+        subtracted if so) are reduced in the IOC, by stats1 for the whole
+        frame and by stats2 to stats5 for the regions of interest roi1 to
+        roi4. The reduced values are read in every event, so live plots,
+        suspenders and quick looks need not open the images. The regions
+        are part of the configuration. This replaces any previous reduced
+        readout; ``reduced_readout(values=())`` turns it off.
+
+        Parameters
+        ----------
+        rois : list of (min_x, min_y, size_x, size_y), optional
+            up to 4 regions, in pixels
+        values : list of str, optional
+            any of 'total', 'mean', 'std' (of the intensity), 'min', 'max',
+            'centroid' and 'sigma' (its width, in x and y)
+
+        Returns
+        -------
+        signals : list
+            the signals read, e.g. for a MonitorStream
+
+        Example
+        -------
+        >>> pe2.reduced_readout([(1000, 1000, 64, 64)], ['total', 'centroid'])
+        >>> RE(count([pe2], 10), LivePlot('pe2_stats2_total'))
+
+        With stream_tseries, which has no per-point read, record them as a
+        stream of their own:
+
+        >>> reduced = MonitorStream('pe2_reduced', pe2h.reduced_readout())
+        >>> RE(monitor_streams_wrapper(stream_tseries(pe2h, 600), [reduced]))
+        """
+        if len(rois) > 4:
+            raise ValueError("At most 4 regions, not {}".format(len(rois)))
+        unknown = set(values) - set(self.REDUCED_VALUES)
+        if unknown:
+            raise ValueError("Unknown values {}, use some of {}".format(
+                sorted(unknown), sorted(self.REDUCED_VALUES)))
+        fields = [f for value in values for f in self.REDUCED_VALUES[value]]
+        centroid = bool({'centroid', 'sigma'} & set(values))
+        proc_port = self.proc.port_name.get()
+
+        read_attrs = [attr for attr in self.read_attrs
+                      if not attr.startswith(('stats', 'roi'))]
+        config_attrs = [attr for attr in self.configuration_attrs
+                        if not attr.startswith('roi')]
+        for i in range(5):
+            stats = getattr(self, 'stats{}'.format(i + 1))
+            for key in ('nd_array_port', 'enable', 'compute_statistics',
+                        'compute_centroid'):
+                stats.stage_sigs.pop(key, None)
+            if i:
+                roi = getattr(self, 'roi{}'.format(i))
+                for key in ('nd_array_port', 'enable', roi.min_xyz.min_x,
+                            roi.min_xyz.min_y, roi.size.x, roi.size.y):
+                    roi.stage_sigs.pop(key, None)
+            if not fields or i > len(rois):
+                continue
+            if i:
+                # the region, cut out of the frames written
+                min_x, min_y, size_x, size_y = rois[i - 1]
+                roi.stage_sigs.update([('nd_array_port', proc_port),
+                                       ('enable', 1),
+                                       (roi.min_xyz.min_x, min_x),
+                                       (roi.min_xyz.min_y, min_y),
+                                       (roi.size.x, size_x),
+                                       (roi.size.y, size_y),
+                                       ])
+                source_port = roi.port_name.get()
+                config_attrs += ['{}.min_xyz'.format(roi.attr_name),
+                                 '{}.size'.format(roi.attr_name)]
+            else:
+                source_port = proc_port
+            stats.stage_sigs.update([('nd_array_port', source_port),
+                                     ('enable', 1),
+                                     ('compute_statistics', 1),
+                                     ('compute_centroid', int(centroid)),
+                                     ])
+            read_attrs += ['{}.{}'.format(stats.attr_name, field)
+                           for field in fields]
+        self.read_attrs = read_attrs
+        self.configuration_attrs = config_attrs
+
+        signals = []
+        for attr in read_attrs:
+            if attr.startswith('stats'):
+                obj = self
+                for part in attr.split('.'):
+                    obj = getattr(obj, part)
+                signals.append(obj)
+        return signals
+
+
+class XPDPerkinElmer(XPDPerkinElmerBase):
+    "Writing a TIFF file per set of frames"
+    tiff = C(XPDTIFFPlugin, 'TIFF1:',
+             write_path_template='/a/b/c/',
+             read_path_template='/a/b/c',
+             cam_name='cam',  # used to configure "tiff squashing"
+             proc_name='proc',  # ditto
+             read_attrs=[],
+             root='/nsls2/xf28id2/')
+
+    proc = C(ProcessPlugin, 'Proc1:')
+
+
+class XPDPerkinElmerHDF5(XPDPerkinElmerBase):
+    """
+    Writing a single HDF5 file per run, instead of a TIFF file per set.
+
+    Like the TIFF squashing, each set of ``images_per_set`` frames is
+    averaged by ``proc`` into one frame. A chunk holds one whole frame, so
+    reading a frame back is a single read.
+    """
+    hdf5 = C(XPDHDF5Plugin, 'HDF1:',
+             write_path_template='/a/b/c/',
+             read_path_template='/a/b/c',
+             read_attrs=[],
+             root='/nsls2/xf28id2/')
+
+    proc = C(ProcessPlugin, 'Proc1:')
+
+    def stage(self):
+        images_per_set = self.images_per_set.get()
+        self.cam.stage_sigs.update([
+            ('num_images', images_per_set * self.number_of_sets.get()),
+            ('image_mode', 'Multiple'),
+            ])
+        self.proc.stage_sigs.update([
+            ('nd_array_port', self.cam.port_name.get()),
+            ('filter_type', 'RecursiveAve'),
+            ('filter_callbacks', 'Array N only'),
+            ('num_filter', images_per_set),
+            ('auto_reset_filter', 1),
+            ('reset_filter', 1),
+            ('enable_filter', 1),
+            ])
+        self.hdf5.stage_sigs.update([
+            ('nd_array_port', self.proc.port_name.get()),
+            ('num_row_chunks', self.cam.array_size.array_size_y.get()),
+            ('num_col_chunks', self.cam.array_size.array_size_x.get()),
+            ])
+        return super().stage()
+
 
 class ContinuousAcquisitionTrigger(BlueskyInterface):
     """
@@ -255,6 +661,220 @@ class PerkinElmerStandard(SingleTrigger, XPDPerkinElmer):
 class PerkinElmerMulti(MultiTrigger, XPDPerkinElmer):
     shutter = C(EpicsSignal, 'XF:28IDC-ES:1{Sh:Exp}Cmd-Cmd')
 
+class PerkinElmerStandardHDF5(SingleTrigger, XPDPerkinElmerHDF5):
+    pass
+
+
+class PerkinElmerStream:
+    """
+    Flyer recording the frames of a continuously acquiring detector, at its
+    own rate, as they are written to a single HDF5 file.
+
+    ``kickoff`` starts one capture session of the HDF5 plugin, fed by
+    ``proc`` averaging each ``images_per_set`` frames, and the session
+    lasts until ``complete``: there is no round trip to the IOC per frame.
+    Each frame written (an increment of ``num_captured``) gets a datum and
+    an event, timestamped by the IOC; frames counted in one update, when
+    the monitor skipped values, are spread evenly since the previous one.
+    The statistics of ``reduced_readout`` are computed too, to be recorded
+    with a MonitorStream. ``collect_asset_docs`` and ``collect`` hand over
+    what was buffered so far, so they can be called repeatedly during the
+    run (see ``stream_tseries``): ``collect`` only gives the events whose
+    datums were handed over by the previous ``collect_asset_docs``.
+
+    Parameters
+    ----------
+    det : XPDPerkinElmerHDF5
+        already acquiring, in Continuous image mode
+    num : int, optional
+        number of frames after which ``complete`` finishes, otherwise it
+        stops the capture right away
+    name : str, optional
+        name of the event stream
+    """
+    def __init__(self, det, num=None, name='primary'):
+        self.det = det
+        self.num = num
+        self.name = name
+        self.parent = None
+        self._lock = threading.Lock()
+        # resource and datum documents, and the events referencing them
+        self._asset_docs = []
+        self._events = []
+        # number of the buffered events whose datums were handed over
+        self._ready = 0
+        self._captured = 0
+        self._last_time = None
+        self._status = None
+        self._stopping = False
+        # the detector's own stage_sigs, restored when the stream stops
+        self._saved_stage_sigs = {}
+
+    @property
+    def _image_name(self):
+        return '{}_image'.format(self.det.name)
+
+    def describe_collect(self):
+        cam = self.det.cam
+        return {self.name: {self._image_name: {
+            'source': 'PV:{}'.format(self.det.hdf5.prefix),
+            'dtype': 'array',
+            'shape': [cam.array_size.array_size_y.get(),
+                      cam.array_size.array_size_x.get()],
+            'external': 'FILESTORE:'}}}
+
+    def _reduction_plugins(self):
+        # the ROI and stats plugins set up by reduced_readout
+        plugins = [getattr(self.det, 'roi{}'.format(i)) for i in range(1, 5)]
+        plugins += [getattr(self.det, 'stats{}'.format(i))
+                    for i in range(1, 6)]
+        return [plugin for plugin in plugins
+                if 'nd_array_port' in plugin.stage_sigs]
+
+    def describe_configuration(self):
+        return self.det.describe_configuration()
+
+    def read_configuration(self):
+        return self.det.read_configuration()
+
+    def kickoff(self):
+        det = self.det
+        if det.cam.acquire.get() != 1:
+            raise RuntimeError("The PerkinElmerStream expects the detector "
+                               "to already be acquiring.")
+        self._saved_stage_sigs = {plugin: plugin.stage_sigs.copy()
+                                  for plugin in (det.proc, det.hdf5)}
+        det.proc.stage_sigs.update(det._dark_stage_sigs())
+        det.proc.stage_sigs.update([
+            ('nd_array_port', det.cam.port_name.get()),
+            ('filter_type', 'RecursiveAve'),
+            ('filter_callbacks', 'Array N only'),
+            ('num_filter', det.images_per_set.get()),
+            ('auto_reset_filter', 1),
+            ('reset_filter', 1),
+            ('enable_filter', 1),
+            ])
+        det.hdf5.stage_sigs.update([
+            ('nd_array_port', det.proc.port_name.get()),
+            ('num_row_chunks', det.cam.array_size.array_size_y.get()),
+            ('num_col_chunks', det.cam.array_size.array_size_x.get()),
+            ])
+        with self._lock:
+            self._asset_docs = []
+            self._events = []
+            self._ready = 0
+            self._captured = 0
+            self._last_time = ttime.time()
+            self._status = None
+            self._stopping = False
+        det.hdf5.streaming = True
+        det.proc.stage()
+        for plugin in self._reduction_plugins():
+            plugin.stage()
+        # drop what a previous use left, then open the file and start
+        # capturing, which generates the resource
+        det.hdf5._asset_docs_cache.clear()
+        det.hdf5.stage()
+        with self._lock:
+            self._take_asset_docs()
+        det.hdf5.num_captured.subscribe(self._num_captured_changed,
+                                        run=False)
+        return DeviceStatus(self, done=True, success=True)
+
+    def _num_captured_changed(self, value=None, timestamp=None, **kwargs):
+        timestamp = timestamp or ttime.time()
+        with self._lock:
+            # monitors may skip values: every frame counted gets a datum,
+            # and a time between the previous update and this one
+            new = value - self._captured
+            start = min(self._last_time, timestamp)
+            for i in range(1, new + 1):
+                self._captured += 1
+                t = start + (timestamp - start) * i / new
+                datum_id = self.det.hdf5.generate_datum(self._image_name, t,
+                                                        {})
+                self._events.append({
+                    'time': t,
+                    'data': {self._image_name: datum_id},
+                    'timestamps': {self._image_name: t},
+                    'filled': {self._image_name: False}})
+            if new > 0:
+                self._last_time = timestamp
+                self._take_asset_docs()
+            stop = self._should_stop()
+        if stop:
+            # not from the monitor's thread: unstaging waits on puts
+            threading.Thread(target=self._stop).start()
+
+    def _take_asset_docs(self):
+        # with the lock held: move the documents generated by the HDF5
+        # plugin to our buffer, so they are handed over with their events
+        cache = self.det.hdf5._asset_docs_cache
+        while cache:
+            self._asset_docs.append(cache.popleft())
+
+    def _should_stop(self):
+        # with the lock held; True only once
+        if (self._status is None or self._stopping or
+                (self.num is not None and self._captured < self.num)):
+            return False
+        self._stopping = True
+        return True
+
+    def _stop(self):
+        # Run on a thread from the monitor: an exception must fail the
+        # status, or the plan waiting on it would hang.
+        try:
+            self.det.hdf5.num_captured.clear_sub(self._num_captured_changed)
+            # closes the file
+            self.det.hdf5.unstage()
+            for plugin in self._reduction_plugins():
+                plugin.unstage()
+            self.det.proc.unstage()
+        except Exception as exc:
+            print('Stopping the stream of {} failed: {!r}'.format(
+                self.det.name, exc))
+            success = False
+        else:
+            success = True
+        finally:
+            self.det.hdf5.streaming = False
+            for plugin, stage_sigs in self._saved_stage_sigs.items():
+                plugin.stage_sigs.clear()
+                plugin.stage_sigs.update(stage_sigs)
+            self._saved_stage_sigs = {}
+        self._status._finished(success=success)
+
+    def complete(self):
+        with self._lock:
+            self._status = DeviceStatus(self)
+            stop = self._should_stop()
+        if stop:
+            self._stop()
+        return self._status
+
+    def collect(self):
+        with self._lock:
+            events = self._events[:self._ready]
+            del self._events[:self._ready]
+            self._ready = 0
+        yield from events
+
+    def collect_asset_docs(self):
+        with self._lock:
+            docs, self._asset_docs = self._asset_docs, []
+            self._ready = len(self._events)
+        yield from docs
+
+    def stop(self, *, success=False):
+        with self._lock:
+            if self._status is None:
+                self._status = DeviceStatus(self)
+            stop = self.det.hdf5.streaming and not self._stopping
+            self._stopping = True
+        if stop:
+            self._stop()
+
 
 # PE1/2/3 PV prefixes in one place:
 pe1_pv_prefix = 'XF:28IDC-ES:1{Det:PE1}'
@@ -276,34 +896,75 @@ pe1c = PerkinElmerContinuous(pe1_pv_prefix, name='pe1',
                              plugin_name='tiff')
 """
 
-# PE2 detector configurations:
-pe2 = PerkinElmerStandard(pe2_pv_prefix, name='pe2', read_attrs=['tiff'])
-pe2m = PerkinElmerMulti(pe2_pv_prefix, name='pe2', read_attrs=['tiff'],
-                        trigger_cycle=[[('image', {shctl1: 1}),
-                                        ('dark_image', {shctl1: 0})]])
-pe2c = PerkinElmerContinuous(pe2_pv_prefix, name='pe2',
-                             read_attrs=['tiff', 'stats1.total'],
-                             plugin_name='tiff')
+# Update read/write paths for all the detectors in once (this is run when
+# each detector is constructed):
+def _configure_paths(det):
+    writer = det.hdf5 if isinstance(det, XPDPerkinElmerHDF5) else det.tiff
+    writer.read_path_template = f'/nsls2/xf28id2/{det.name}_data/%Y/%m/%d/'
+    writer.write_path_template = f'G:\\{det.name}_data\\%Y\\%m\\%d\\'
 
 
 # PE2 detector configurations:
-pe3 = PerkinElmerStandard(pe3_pv_prefix, name='pe3', read_attrs=['tiff'])
-pe3m = PerkinElmerMulti(pe3_pv_prefix, name='pe3', read_attrs=['tiff'],
-                        trigger_cycle=[[('image', {shctl1: 1}),
-                                        ('dark_image', {shctl1: 0})]])
-pe3c = PerkinElmerContinuous(pe3_pv_prefix, name='pe3',
-                             read_attrs=['tiff', 'stats1.total'],
-                             plugin_name='tiff')
+pe2 = lazy_device(PerkinElmerStandard, pe2_pv_prefix, name='pe2',
+                  read_attrs=['tiff'], configure=_configure_paths)
+pe2m = lazy_device(PerkinElmerMulti, pe2_pv_prefix, name='pe2',
+                   read_attrs=['tiff'],
+                   trigger_cycle=[[('image', {shctl1: 1}),
+                                   ('dark_image', {shctl1: 0})]],
+                   configure=_configure_paths)
+pe2c = lazy_device(PerkinElmerContinuous, pe2_pv_prefix, name='pe2',
+                   read_attrs=['tiff', 'stats1.total'],
+                   plugin_name='tiff', configure=_configure_paths)
+# one HDF5 file per run instead of a TIFF per point, see XPDPerkinElmerHDF5
+pe2h = lazy_device(PerkinElmerStandardHDF5, pe2_pv_prefix, name='pe2',
+                   read_attrs=['hdf5'], configure=_configure_paths)
 
 
-# Update read/write paths for all the detectors in once:
-for det in [
-            # pe1, pe1m, pe1c,
-            pe2, pe2m, pe2c,
-            pe3, pe3m, pe3c,
-            ]:
-    det.tiff.read_path_template = f'/nsls2/xf28id2/{det.name}_data/%Y/%m/%d/'
-    det.tiff.write_path_template = f'G:\\{det.name}_data\\%Y\\%m\\%d\\'
+# PE2 detector configurations:
+pe3 = lazy_device(PerkinElmerStandard, pe3_pv_prefix, name='pe3',
+                  read_attrs=['tiff'], configure=_configure_paths)
+pe3m = lazy_device(PerkinElmerMulti, pe3_pv_prefix, name='pe3',
+                   read_attrs=['tiff'],
+                   trigger_cycle=[[('image', {shctl1: 1}),
+                                   ('dark_image', {shctl1: 0})]],
+                   configure=_configure_paths)
+pe3c = lazy_device(PerkinElmerContinuous, pe3_pv_prefix, name='pe3',
+                   read_attrs=['tiff', 'stats1.total'],
+                   plugin_name='tiff', configure=_configure_paths)
+pe3h = lazy_device(PerkinElmerStandardHDF5, pe3_pv_prefix, name='pe3',
+                   read_attrs=['hdf5'], configure=_configure_paths)
 
 # some defaults, as an example of how to use this
 # pe1.configure(dict(images_per_set=6, number_of_sets=10))
+
+
+def compare_file_writers(detectors=None, num=50):
+    """
+    Time writing ``num`` points, and reading them back, with each detector.
+
+    Meant to compare the TIFF and the HDF5 writers of a detector, e.g. pe2
+    (a TIFF per point) and pe2h (one HDF5 file). Each detector is counted
+    with its current images_per_set and number_of_sets.
+
+    Returns
+    -------
+    results : dict
+        {detector: (write seconds, read seconds)}
+    """
+    if detectors is None:
+        detectors = [pe2, pe2h]
+    results = {}
+    for det in detectors:
+        writer = det.__class__.__name__
+        t0 = ttime.perf_counter()
+        uid, = RE(count([det], num))
+        t_write = ttime.perf_counter() - t0
+        t0 = ttime.perf_counter()
+        for _ in db[uid].data('{}_image'.format(det.name)):
+            pass
+        t_read = ttime.perf_counter() - t0
+        results[det] = (t_write, t_read)
+        print('{:<24} write {:7.2f} s ({:6.1f} points/s)  '
+              'read {:7.2f} s ({:6.1f} points/s)'.format(
+                  writer, t_write, num / t_write, t_read, num / t_read))
+    return results
@@ -1,10 +1,17 @@
-import asyncio
+import csv
+import hashlib
+import os
+import threading
+import time as ttime
+from collections import namedtuple
 from ophyd import Device, EpicsSignal, EpicsSignalRO
 from ophyd import Component as C
+from ophyd.device import DeviceStatus
+from ophyd.status import wait as status_wait
 from ophyd.utils import set_and_wait
 from bluesky import Msg
 from bluesky.plans import count, list_scan
-from bluesky.plan_stubs import abs_set, open_run, close_run
+from bluesky.plan_stubs import abs_set, open_run, close_run, wait
 from bluesky.utils import single_gen
 from bluesky.preprocessors import subs_wrapper, pchain
 from bluesky.callbacks import LiveTable
@@ -27,6 +34,11 @@ class Robot(Device):
 
     DIFF_POS = {'capilary': (1, 2), }
 
+    # Give up on a robot command after this many seconds.
+    CMD_TIMEOUT = 300
+    # Theta moves smaller than this (degrees) are skipped.
+    TH_TOL = 0.01
+
     def __init__(self, *args, theta, diff=None, **kwargs):
         """
         Parameters
@@ -36,112 +48,211 @@ class Robot(Device):
         """
         self.theta = theta
         self._current_sample_geometry = None
+        # statuses completed by PV monitors, so stop() can fail them
+        self._watches = []
+        # set by stop(), checked by the load/unload worker between steps
+        self._stop_requested = threading.Event()
+        # seconds spent on each step of the last load/unload
+        self.timing = {}
         super().__init__(*args, **kwargs)
 
-    def _poll_until_idle(self):
-        time.sleep(3)  # give it plenty of time to start
-        while self.status.get() != 'Idle':
-            time.sleep(.1)
+    def _when(self, signal, predicate):
+        """
+        Return a status finished by a monitor on ``signal`` as soon as
+        ``predicate(value)`` is true.
+
+        The monitor is removed however the status finishes: by the
+        predicate, on timeout or by ``stop()``.
+        """
+        status = DeviceStatus(self, timeout=self.CMD_TIMEOUT)
+
+        def watcher(value, **kwargs):
+            if predicate(value) and not status.done:
+                status._finished()
+
+        def unsubscribe(*args, **kwargs):
+            signal.clear_sub(watcher)
+
+        self._watches.append(status)
+        signal.subscribe(watcher, event_type=signal.SUB_VALUE, run=True)
+        status.add_callback(unsubscribe)
+        return status
+
+    def _when_idle_again(self):
+        "Status finished when the robot goes busy and then back to 'Idle'."
+        seen_busy = []
+
+        def idle_again(value):
+            if value != 'Idle':
+                seen_busy.append(value)
+                return False
+            return bool(seen_busy)
+
+        return self._when(self.status, idle_again)
 
-    def _poll_until_sample_cleared(self):
-        while self.current_sample_number.get() != 0:
-            time.sleep(.1)
+    def _when_sample_cleared(self):
+        return self._when(self.current_sample_number, lambda value: value == 0)
+
+    def _run_in_thread(self, func, *args):
+        """
+        Run the steps of a load/unload in a worker thread.
+
+        The returned status is finished when they are done, so callers
+        (and the RunEngine) are not blocked. ``stop()`` makes the worker
+        give up at its next step.
+        """
+        status = DeviceStatus(self)
+        self._stop_requested.clear()
+
+        def target():
+            try:
+                func(*args)
+            except Exception as exc:
+                print('Robot failed: {!r}'.format(exc))
+                status._finished(success=False)
+            else:
+                status._finished()
+            finally:
+                self._watches = [st for st in self._watches if not st.done]
+
+        threading.Thread(target=target, daemon=True).start()
+        return status
+
+    def _check_stopped(self):
+        if self._stop_requested.is_set():
+            raise RuntimeError("The robot was stopped.")
+
+    def _wait(self, step, status):
+        "Wait for a status, adding the time it took to ``timing[step]``."
+        t0 = ttime.time()
+        try:
+            status_wait(status)
+        finally:
+            self.timing[step] += ttime.time() - t0
+        self._check_stopped()
+
+    def _move_theta(self, position):
+        self._check_stopped()
+        # skip the move (and its round trips) if theta is already there
+        if abs(self.theta.position - position) > self.TH_TOL:
+            self._wait('theta', self.theta.set(position))
 
     def load_sample(self, sample_number, sample_geometry=None):
+        self.timing = {'theta': 0, 'robot': 0}
         # If no sample is loaded, current_sample_number=0
         # is reported by the robot.
-        if self.current_sample_number.get() != 0:
-            raise RuntimeError(
-                "Sample %d is already loaded." % self.current_sample_number.get())
-
+        current = self.current_sample_number.get()
+        if current == sample_number:
+            # The load is replayed when a paused plan is resumed: finish it
+            # if it was stopped after the robot had loaded the sample.
+            if sample_geometry == self._current_sample_geometry:
+                return DeviceStatus(self, done=True, success=True)
+            return self._run_in_thread(self._to_measure_position,
+                                       sample_geometry)
+        if current != 0:
+            raise RuntimeError("Sample %d is already loaded." % current)
+        return self._run_in_thread(self._load, sample_number, sample_geometry)
+
+    def _load(self, sample_number, sample_geometry):
         # Rotate theta into loading position if necessary (e.g. flat plate mode).
         load_pos = self.TH_POS[sample_geometry]['load']
         if load_pos is not None:
             if sample_geometry not in self.REL_MOVES:
                 print('Moving theta to load position')
-                self.theta.move(load_pos, wait=True)
+                self._move_theta(load_pos)
 
         # Loading the sample is a three-step procedure:
         # Set sample_number; issue load_cmd; issue execute_cmd.
-        set_and_wait(self.sample_number, sample_number)
+        # (sample_queue may have set sample_number already.)
+        if self.sample_number.get() != sample_number:
+            set_and_wait(self.sample_number, sample_number)
         set_and_wait(self.load_cmd, 1)
+        idle = self._when_idle_again()
+        self._check_stopped()
         self.execute_cmd.put(1)
         print('Loading...')
-        self._poll_until_idle()
+        self._wait('robot', idle)
+        self._to_measure_position(sample_geometry)
 
+    def _to_measure_position(self, sample_geometry):
         # Rotate theta into measurement position if necessary (e.g. flat plate mode).
         measure_pos = self.TH_POS[sample_geometry]['measure']
         if measure_pos is not None:
             print('Moving theta to measure position')
             if sample_geometry not in self.REL_MOVES:
-                self.theta.move(measure_pos, wait=True)
+                self._move_theta(measure_pos)
             else:
-                pos = self.theta.get()
-                self.theta.move(pos + measure_pos, wait=True)
+                pos = self.theta.position
+                self._move_theta(pos + measure_pos)
 
         # Stash the current sample geometry for reference when we unload.
         self._current_sample_geometry = sample_geometry
 
     def unload_sample(self):
+        self.timing = {'theta': 0, 'robot': 0}
         if self.current_sample_number.get() == 0:
             # there is nothing to do
-            return
+            return DeviceStatus(self, done=True, success=True)
+        return self._run_in_thread(self._unload)
 
+    def _unload(self):
         # Rotate theta into loading position if necessary (e.g. flat plate mode).
         load_pos = self.TH_POS[self._current_sample_geometry]['load']
         measure_pos = self.TH_POS[self._current_sample_geometry]['measure']
         if load_pos is not None:
             print('Moving theta to measure position')
             if self._current_sample_geometry not in self.REL_MOVES:
-                self.theta.move(load_pos, wait=True)
+                self._move_theta(load_pos)
             else:
-                pos = self.theta.get()
-                self.theta.move(pos - measure_pos, wait=True)
+                pos = self.theta.position
+                self._move_theta(pos - measure_pos)
         if load_pos is not None:
             print('Moving theta to unload position')
-            self.theta.move(load_pos, wait=True)
+            self._move_theta(load_pos)
 
         set_and_wait(self.unload_cmd, 1)
+        idle = self._when_idle_again()
+        cleared = self._when_sample_cleared()
+        self._check_stopped()
         self.execute_cmd.put(1)
         print('Unloading...')
-        self._poll_until_idle()
-        self._poll_until_sample_cleared()
+        self._wait('robot', idle)
+        self._wait('robot', cleared)
         self._current_sample_geometry = None
 
-    def stop(self):
-        self.theta.stop()
-        super().stop()
-
-
-# Define custom commands for sample loading/unloading.
-
-@asyncio.coroutine
-def _load_sample(msg):
-    msg.obj.load_sample(*msg.args, **msg.kwargs)
-
-
-@asyncio.coroutine
-def _unload_sample(msg):
-    msg.obj.unload_sample(*msg.args, **msg.kwargs)
-
-
-# Register these custom command with the RunEngine.
+    def set(self, sample_number, sample_geometry=None):
+        """
+        Load a sample, or unload the current one if ``sample_number`` is
+        None, as a movable: see ``load_sample`` and ``unload_sample``.
+        """
+        if sample_number is None:
+            return self.unload_sample()
+        return self.load_sample(sample_number, sample_geometry)
 
-RE.register_command('load_sample', _load_sample)
-RE.register_command('unload_sample', _unload_sample)
+    def stop(self, *, success=False):
+        """
+        Stop a load/unload in progress: the worker gives up at its next
+        step, and the statuses it waits on fail.
+        """
+        self._stop_requested.set()
+        self.theta.stop()
+        for status in self._watches:
+            if not status.done:
+                status._finished(success=False)
+        self._watches = []
+        super().stop(success=success)
 
 
-# For convenience, define short plans the use these custom commands.
+# Short plans loading and unloading through ``robot.set``: the RunEngine
+# running them (RE or xrun) tracks the robot like any other movable, and
+# calls robot.stop() when the plan is paused or aborted.
 
 def load_sample(position, geometry=None):
-    # TODO: I think this can be simpler.
-    return (
-        yield from single_gen(Msg('load_sample', robot, position, geometry)))
+    return (yield from abs_set(robot, position, geometry, wait=True))
 
 
 def unload_sample():
-    # TODO: I think this can be simpler.
-    return (yield from single_gen(Msg('unload_sample', robot)))
+    return (yield from abs_set(robot, None, wait=True))
 
 
 # These are usable bluesky plans.
@@ -165,6 +276,112 @@ def robot_wrapper(plan, sample):
     yield from unload_sample()
 
 
+# Per-sample timings of the last sample_queue, see sample_queue_summary().
+sample_queue_timings = []
+
+
+def _prefetch_next(sample, next_sample):
+    """
+    Start preparing the load of ``next_sample`` while ``sample`` is measured,
+    in the 'prefetch' group: the robot setpoint, and theta's load position
+    if ``sample`` does not depend on theta (no measure position) and the
+    unload of ``sample`` will not move it.
+    """
+    yield from abs_set(robot.sample_number, next_sample['position'],
+                       group='prefetch')
+    current = Robot.TH_POS[sample.get('geometry')]
+    geometry = next_sample.get('geometry')
+    load_pos = Robot.TH_POS[geometry]['load']
+    if (load_pos is not None and geometry not in Robot.REL_MOVES and
+            current['measure'] is None and current['load'] is None):
+        yield from abs_set(robot.theta, load_pos, group='prefetch')
+
+
+def sample_queue(samples, plan_factory=None, prefetch=True):
+    """Measure a queue of samples with the robot, timing every changeover.
+
+    Theta is only moved when it is not already in place, so consecutive
+    samples of the same geometry skip the round trips to the load position.
+    While a sample is measured, the load of the next one is prepared in the
+    background (see ``_prefetch_next``) and waited on after the exposure.
+    The time spent loading (theta moves and robot), measuring, waiting for
+    the prefetch and unloading each sample is kept in
+    ``sample_queue_timings`` and summarized at the end.
+
+    Parameters
+    ----------
+    samples : iterable of dict
+        like the ``sample`` of ``robot_wrapper``: 'position' and optionally
+        'geometry', plus any metadata. It is consumed one sample ahead.
+    plan_factory : callable, optional
+        ``plan_factory(sample)`` returns the plan measuring one sample;
+        defaults to ``count([], md=sample)``
+    prefetch : bool, optional
+        prepare the next sample during the exposure. This writes the next
+        sample number to ``robot.sample_number`` before the current sample
+        is unloaded: disable it if the robot controller does not ignore
+        that setpoint until the next load command.
+
+    Example
+    -------
+    >>> RE(sample_queue(samples, lambda s: count([pe2c], md=s)))
+    """
+    if plan_factory is None:
+        def plan_factory(sample):
+            return count([], md=sample)
+    del sample_queue_timings[:]
+    samples = iter(samples)
+    sample = next(samples, None)
+    while sample is not None:
+        next_sample = next(samples, None)
+        timing = {'position': sample['position']}
+
+        t0 = ttime.time()
+        yield from load_sample(sample['position'], sample.get('geometry'))
+        timing['load'] = ttime.time() - t0
+        timing['load_theta'] = robot.timing['theta']
+        timing['load_robot'] = robot.timing['robot']
+
+        if prefetch and next_sample is not None:
+            yield from _prefetch_next(sample, next_sample)
+        t0 = ttime.time()
+        yield from plan_factory(sample)
+        timing['measure'] = ttime.time() - t0
+        t0 = ttime.time()
+        if prefetch:
+            yield from wait('prefetch')
+        timing['prefetch'] = ttime.time() - t0
+
+        t0 = ttime.time()
+        yield from unload_sample()
+        timing['unload'] = ttime.time() - t0
+        timing['unload_theta'] = robot.timing.get('theta', 0)
+        timing['unload_robot'] = robot.timing.get('robot', 0)
+
+        sample_queue_timings.append(timing)
+        sample = next_sample
+    sample_queue_summary()
+
+
+def sample_queue_summary(timings=None):
+    "Print where the time went in a sample_queue, per sample and in total."
+    if timings is None:
+        timings = sample_queue_timings
+    columns = ['position', 'load', 'load_theta', 'load_robot', 'measure',
+               'prefetch', 'unload', 'unload_theta', 'unload_robot']
+    print(' '.join('{:>12}'.format(c) for c in columns))
+    for timing in timings:
+        print(' '.join('{:>12.1f}'.format(timing.get(c, 0)) if c != 'position'
+                       else '{:>12}'.format(timing[c]) for c in columns))
+    changeover = sum(t['load'] + t['unload'] for t in timings)
+    measure = sum(t['measure'] for t in timings)
+    if changeover + measure:
+        print('changeover {:.1f} s, measuring {:.1f} s ({:.0%} changeover)'
+              .format(changeover, measure,
+                      changeover / (changeover + measure)))
+
+
+
 def ct(sample, exposure):
     """
     Capture how many exposures are needed to get a total exposure
@@ -182,6 +399,9 @@ def tseries(sample, exposure, num):
     Capture how ever many exposures are needed to get a total exposure
     of the given value, and divide those into files of 'num' exposures
     each, summed.
+
+    Each file is a separate capture, with a gap in between: see
+    stream_tseries for a time series at the detector's frame rate.
     """
     if pe1c.cam.acquire_time.get() != 0.1:
         raise RuntimeError("We expect pe1c.cam.acquire_time to be 0.1")
@@ -215,23 +435,163 @@ def example():
         yield from robot_wrapper(plan, sample)
 
 
+# Sample sheets: one sample per row, columns sample name, phase info,
+# background name and position, then any other columns. The geometry is
+# read from the column headed 'geometry', if there is one. The first row
+# after the header is a description row and is skipped.
+
+SampleRecord = namedtuple('SampleRecord', ['sample_name', 'phase_info',
+                                           'bg_name', 'position', 'geometry'])
+
+# path -> (mtime, size, sha1); (sha1, geometry, skip_rows) -> records
+_sample_sheet_stats = {}
+_sample_sheet_cache = {}
+
+
+class SampleSheetError(ValueError):
+    pass
+
+
+def _sample_sheet_rows(filename):
+    "Yield the rows of a .xlsx or .csv sheet as tuples, streaming."
+    if filename.lower().endswith('.csv'):
+        with open(filename, newline='') as f:
+            for row in csv.reader(f):
+                yield tuple(value if value != '' else None for value in row)
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _sample_sheet_digest(filename):
+    st = os.stat(filename)
+    known = _sample_sheet_stats.get(filename)
+    if known is not None and known[:2] == (st.st_mtime, st.st_size):
+        return known[2]
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    _sample_sheet_stats[filename] = (st.st_mtime, st.st_size, sha.hexdigest())
+    return sha.hexdigest()
+
+
+def read_sample_sheet(filename, geometry=None, skip_rows=1):
+    """
+    Parse and validate a sample sheet.
+
+    The whole sheet is checked before anything is measured: every position
+    must be a positive integer (the robot reports 0 for no sample) used
+    only once, and every geometry must be known to ``Robot.TH_POS``. All
+    the problems are
+    reported together. The result is cached on the content of the file, so
+    re-reading an unchanged sheet is free.
+
+    Only the first four columns are read, plus a geometry column if the
+    header names one, so sheets with extra columns are accepted.
+
+    Parameters
+    ----------
+    filename : str
+        .xlsx or .csv file
+    geometry : str, optional
+        geometry of the samples that do not give one in the sheet
+    skip_rows : int, optional
+        rows to skip after the header
+
+    Returns
+    -------
+    samples : list of SampleRecord
+    """
+    filename = os.path.realpath(filename)
+    key = (_sample_sheet_digest(filename), geometry, skip_rows)
+    if key in _sample_sheet_cache:
+        return _sample_sheet_cache[key]
+
+    samples = []
+    errors = []
+    seen = {}
+    rows = _sample_sheet_rows(filename)
+    header = [str(value).strip().lower() if value is not None else None
+              for value in next(rows, ())]
+    geometry_column = header.index('geometry') if 'geometry' in header else None
+    for row_number, row in enumerate(rows, start=2):
+        if row_number < 2 + skip_rows:
+            continue
+        row = tuple(row) + (None,) * (max(len(header), 4) - len(row))
+        if all(value is None for value in row[:4]):
+            continue
+        name, phase, bg_name, position = row[:4]
+        row_geometry = None
+        if geometry_column is not None:
+            row_geometry = row[geometry_column]
+        if row_geometry is None:
+            row_geometry = geometry
+        try:
+            if not float(position).is_integer():
+                raise ValueError
+            position = int(float(position))
+        except (TypeError, ValueError):
+            errors.append('row {}: position {!r} is not an integer'
+                          .format(row_number, row[3]))
+        else:
+            if position < 1:
+                errors.append('row {}: position {} is out of range'
+                              .format(row_number, position))
+            elif position in seen:
+                errors.append('row {}: position {} is already used in row {}'
+                              .format(row_number, position, seen[position]))
+            seen.setdefault(position, row_number)
+        if row_geometry not in Robot.TH_POS:
+            errors.append('row {}: unknown geometry {!r}'
+                          .format(row_number, row_geometry))
+        samples.append(SampleRecord(name, phase, bg_name, position,
+                                    row_geometry))
+    if errors:
+        raise SampleSheetError('{} problems in {}:\n    {}'.format(
+            len(errors), filename, '\n    '.join(errors)))
+    _sample_sheet_cache[key] = samples
+    return samples
+
+
+def sample_sheet_plan(filename, geometry=None, plan_factory=None,
+                      skip_rows=1):
+    """
+    Measure every sample of a sample sheet with the robot.
+
+    The sheet is validated (see ``read_sample_sheet``) when the plan is
+    created, so a bad row fails before the first robot move; the per-sample
+    plans are then built one at a time as the queue advances.
+
+    Parameters
+    ----------
+    filename : str
+        .xlsx or .csv file
+    geometry : str, optional
+        geometry of the samples that do not give one in the sheet
+    plan_factory : callable, optional
+        see ``sample_queue``
+    skip_rows : int, optional
+        rows to skip after the header
+
+    Example
+    -------
+    >>> RE(sample_sheet_plan('/XF28IDC/XF28ID2/pe2_data/xpdUser/Import/example-with-dan.xlsx'))
+    """
+    records = read_sample_sheet(filename, geometry, skip_rows)
+    samples = (record._asdict() for record in records)
+    return sample_queue(samples, plan_factory)
+
+
 def excel_example(filename, geometry=None):
     """
     Example: RE(excel_example('/XF28IDC/XF28ID2/pe2_data/xpdUser/Import/example-with-dan.xlsx'))
     """
-    import pandas as pd
-    f = pd.ExcelFile(filename)
-    sheet = f.parse()
-    for _, row in sheet.iloc[1:].iterrows():
-        name, phase, bg_name, position = row[:4]
-        position = int(position)
-        sample = {'sample_name': name,
-                  'phase_info': phase,
-                  'bg_name': bg_name,
-                  'position': position,
-                  'geometry': geometry}
-        plan = bp.count([], md=sample)
-        yield from robot_wrapper(plan, sample)
+    return sample_sheet_plan(filename, geometry)
 
 
 # master_plan = pchain(plan(sample) for sample in samples)
@@ -1,9 +1,12 @@
 import os
 import numpy as np
-from bluesky.plan_stubs import (abs_set, )
+from bluesky.plan_stubs import (abs_set, open_run, close_run, monitor,
+                                unmonitor, trigger_and_read, wait, kickoff,
+                                complete, collect, sleep)
 from bluesky.plans import (scan, count, list_scan, adaptive_scan)
-from bluesky.preprocessors import (subs_wrapper, pchain,
-                                   reset_positions_wrapper)
+from bluesky.preprocessors import (subs_wrapper, pchain, finalize_wrapper,
+                                   reset_positions_wrapper, run_decorator,
+                                   stage_decorator)
 from bluesky.callbacks import LiveTable, LivePlot, LiveFit, LiveFitPlot
 from bluesky.plan_tools import print_summary
 
@@ -34,17 +37,186 @@ def MED(init_gas, other_gas, minT, maxT, num_steps, num_steady, num_trans, num_l
     >>> RE(MED('O2', 'C02', 200, 300, 21, 20, 60))
 
     """
+    # The gas and the temperature are recorded at their own rate, in the
+    # 'gas_monitor' and 'temperature_monitor' streams.
+    def with_monitors(plan):
+        return monitor_streams_wrapper(
+            plan, [gas_stream(), temperature_stream(eurotherm)])
+
     # Step 1
     yield from abs_set(gas, init_gas)
     # Steps 2 and 3 in a loop.
     for _ in range(num_loops):
-        yield from subs_wrapper(scan([pe1, gas.current_gas], eurotherm, minT, maxT, num_steps),
-                            LiveTable([eurotherm, gas.current_gas]))
-        yield from subs_wrapper(count([pe1], num_steady), LiveTable([]))
+        yield from subs_wrapper(with_monitors(scan([pe1], eurotherm, minT, maxT, num_steps)),
+                            LiveTable([eurotherm]))
+        yield from subs_wrapper(with_monitors(count([pe1], num_steady)), LiveTable([]))
     # Step 4
     yield from abs_set(gas, other_gas)
-    yield from subs_wrapper(count([pe1], num_steady), LiveTable([]))
+    yield from subs_wrapper(with_monitors(count([pe1], num_steady)), LiveTable([]))
     # Step 6
     yield from abs_set(gas, init_gas)
-    yield from subs_wrapper(count([pe1], num_steady), LiveTable([]))
+    yield from subs_wrapper(with_monitors(count([pe1], num_steady)), LiveTable([]))
+
+class TemperatureRamp:
+    """
+    Movable for plans: ``set(stop)`` ramps ``controller`` to ``stop`` at
+    ``rate`` degrees/min, and the RunEngine's ``stop()`` on pause or abort
+    stops the ramp.
+    """
+    def __init__(self, controller, rate):
+        self.controller = controller
+        self.rate = rate
+        self.name = '{}_ramp'.format(controller.name)
+        self.parent = None
+
+    def set(self, stop):
+        return self.controller.ramp(stop, self.rate)
+
+    def stop(self, *, success=False):
+        self.controller.stop(success=success)
+
+
+# not '<readback>_monitor', which is temperature_stream's 'temperature_monitor'
+RAMP_STREAM = 'ramp_monitor'
+
+
+def temperature_ramp(detectors, controller, stop, rate, *, md=None):
+    """
+    Acquire back to back while the temperature ramps to ``stop``.
+
+    The ramp is started at ``rate`` degrees/min (natively on the Linkam,
+    emulated on the CS700 and Eurotherm) and the detectors are triggered
+    continuously until it has finished and settled, so the whole ramp is
+    one run at the detector's frame rate. If the plan fails or is aborted
+    the ramp is stopped. The temperature readback is
+    monitored during the run: each update is recorded with its timestamp in
+    the 'ramp_monitor' event stream, independently of the frames. Use
+    ``ramp_temperatures`` to get the temperature of each frame.
+
+    Parameters
+    ----------
+    detectors : list
+        at least one detector, they pace the loop
+    controller : cs700, eurotherm or linkam_furnace
+    stop : float
+        final temperature
+    rate : float
+        degrees per minute
+    md : dict, optional
+
+    Example
+    -------
+    >>> RE(temperature_ramp([pe3c], cs700, 500, 10))
+    """
+    if not hasattr(controller, 'ramp'):
+        raise ValueError("{} cannot ramp".format(controller.name))
+    detectors = list(detectors)
+    if not detectors:
+        raise ValueError("temperature_ramp needs at least one detector")
+    readback = controller.settle_readback()
+    _md = {'plan_name': 'temperature_ramp',
+           'detectors': [det.name for det in detectors],
+           'ramp_controller': controller.name,
+           'ramp_readback': readback.name,
+           'ramp_stream': RAMP_STREAM,
+           'ramp_stop': stop,
+           'ramp_rate': rate}
+    _md.update(md or {})
+    ramp = TemperatureRamp(controller, rate)
+    # what has been started, for the cleanup
+    started = {}
+
+    def inner():
+        yield from monitor(readback, name=RAMP_STREAM)
+        started['monitor'] = True
+        status = started['ramp'] = yield from abs_set(ramp, stop,
+                                                      group='ramp')
+        while not status.done:
+            yield from trigger_and_read(detectors)
+        yield from wait('ramp')
+
+    def cleanup():
+        if started.get('monitor'):
+            yield from unmonitor(readback)
+        if 'ramp' in started and not started['ramp'].done:
+            ramp.stop()
+
+    @stage_decorator(detectors)
+    @run_decorator(md=_md)
+    def ramp_plan():
+        return (yield from finalize_wrapper(inner(), cleanup()))
+
+    return (yield from ramp_plan())
+
+
+def ramp_temperatures(header):
+    """
+    Temperature at each frame of a ``temperature_ramp`` run, interpolated
+    from the monitored readbacks.
+
+    Parameters
+    ----------
+    header : Header
+
+    Returns
+    -------
+    times, temperatures : ndarray
+        time of each event of the primary stream, and the temperature then
+    """
+    name = header.start['ramp_readback']
+    stream = header.start.get('ramp_stream', '{}_monitor'.format(name))
+    readings = header.table(stream, convert_times=False)
+    times = np.asarray(header.table('primary', convert_times=False)['time'])
+    temperatures = np.interp(times, readings['time'], readings[name])
+    return times, temperatures
+
+
+def stream_tseries(det, num, *, flush_every=1, md=None):
+    """
+    Time series at the detector's own frame rate.
+
+    The detector must already be acquiring continuously. One capture
+    session of its HDF5 plugin spans the run (see ``PerkinElmerStream``),
+    so there is no gap between frames: each set of ``images_per_set``
+    frames is averaged and written to the file of the run as one point.
+    The points written are saved every ``flush_every`` seconds.
+
+    Parameters
+    ----------
+    det : pe2h or pe3h
+    num : int
+        number of points
+    flush_every : float, optional
+        seconds
+    md : dict, optional
+
+    Example
+    -------
+    >>> pe2h.cam.acquire.put(1)
+    >>> RE(stream_tseries(pe2h, 600))
+    """
+    stream = PerkinElmerStream(det, num)
+    _md = {'plan_name': 'stream_tseries',
+           'detectors': [det.name],
+           'num_points': num,
+           'images_per_set': det.images_per_set.get(),
+           'acquire_time': det.cam.acquire_time.get()}
+    _md.update(md or {})
+
+    def inner():
+        yield from open_run(md=_md)
+        yield from kickoff(stream, wait=True)
+        status = yield from complete(stream, group='stream')
+        while not status.done:
+            yield from sleep(flush_every)
+            yield from collect(stream)
+        yield from wait('stream')
+        yield from collect(stream)
+        yield from close_run()
+
+    def stop_stream():
+        # closes the file if the run failed before the end
+        stream.stop()
+        yield from []
 
+    return (yield from finalize_wrapper(inner(), stop_stream()))
@@ -1,5 +1,11 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bluesky.callbacks import CallbackBase
 from lmfit import Model, Parameter, Parameters
 from lmfit.lineshapes import voigt
+from scipy.optimize import least_squares
 
 def initialize_ecal():
     '''
@@ -105,6 +111,247 @@ def guess_and_fit(xdata, ydata, sigma=None):
     init_guess = guess(xdata, ydata, sigma=sigma)
     return peakmodel.fit(data=ydata, x=xdata, params=init_guess)
 
+
+class AdaptiveDipFit:
+    '''
+        Fit of one dip (or peak), refined point by point, which chooses
+        where to measure next.
+
+        ``peakfunc`` is refit after every point, starting from the previous
+        parameters. The next position is the one of ``candidates`` whose
+        reading is expected to shrink the variance of the fitted center
+        the most: for a reading at x, with model gradient g over the fitted
+        parameters, covariance C and noise variance s2, the variance of x0
+        drops by (C g)[x0]**2 / (s2 + g.C.g).
+
+        Parameters
+        ----------
+        candidates : array
+            the positions to choose from
+        sigma : float
+            a guess of the width, in the units of the positions
+    '''
+    # fewer points than this can't constrain the 5 parameters
+    MIN_POINTS = 7
+
+    def __init__(self, candidates, sigma):
+        self.candidates = np.asarray(candidates)
+        self.sigma = sigma
+        self.x = []
+        self.y = []
+        self.result = None
+        self.model = Model(peakfunc, independent_vars=['x'])
+
+    def add(self, x, y):
+        ''' add a reading and refit'''
+        self.x.append(x)
+        self.y.append(y)
+        if len(self.x) < self.MIN_POINTS:
+            return
+        xdata, ydata = np.array(self.x), np.array(self.y)
+        if self.ok:
+            self.result = self.model.fit(data=ydata, x=xdata,
+                                         params=self.result.params)
+        if not self.ok:
+            params = guess(xdata, ydata, sigma=self.sigma)
+            # keep the width physical, so a single noisy point can't be fit
+            params['sigma'].set(min=self.sigma / 10, max=self.sigma * 10)
+            self.result = self.model.fit(data=ydata, x=xdata, params=params)
+
+    @property
+    def ok(self):
+        ''' whether there is a fit, with errors, centered among the candidates'''
+        return (self.result is not None and self.result.covar is not None and
+                self.candidates.min() <= self.center <= self.candidates.max())
+
+    def found(self, nsigma=5):
+        '''
+            True once the readings have crossed a dip or peak: one off the
+            baseline by nsigma times the noise, then two back on it.
+            The noise is at least the counting noise of the baseline.
+        '''
+        y = np.asarray(self.y)
+        if len(y) < self.MIN_POINTS:
+            return False
+        base = np.median(y)
+        noise = max(1.4826 * np.median(np.abs(y - base)),
+                    np.sqrt(np.abs(base)))
+        off = np.abs(y - base) > nsigma * noise
+        return bool(off.any()) and np.flatnonzero(off)[-1] < len(y) - 2
+
+    @property
+    def center(self):
+        return None if self.result is None else self.result.best_values['x0']
+
+    @property
+    def center_std(self):
+        if not self.ok:
+            return np.inf
+        return self.result.params['x0'].stderr
+
+    def next_position(self):
+        ''' the candidate position most informative about the center'''
+        res = self.result
+        if not self.ok:
+            # no usable fit yet: fill in around the strongest reading
+            y = np.asarray(self.y)
+            x_off = self.x[np.argmax(np.abs(y - np.median(y)))]
+            distance = np.abs(self.candidates - x_off)
+            # the readbacks are never exactly on the candidates: skip the
+            # candidate nearest to each of them
+            measured = np.abs(self.candidates[:, None] -
+                              np.asarray(self.x)[None, :]).argmin(axis=0)
+            distance[measured] = np.inf
+            return self.candidates[np.argmin(distance)]
+        values = res.best_values
+        gradient = []
+        for name in res.var_names:
+            step = 1e-3 * (res.params[name].stderr or abs(values[name]) or 1)
+            up = dict(values, **{name: values[name] + step})
+            down = dict(values, **{name: values[name] - step})
+            gradient.append((peakfunc(self.candidates, **up) -
+                             peakfunc(self.candidates, **down)) / (2 * step))
+        gradient = np.array(gradient)
+        cg = res.covar @ gradient
+        gain = (cg[res.var_names.index('x0')]**2 /
+                (res.redchi + np.sum(gradient * cg, axis=0)))
+        return self.candidates[np.argmax(gain)]
+
+
+
+class RingBuffer:
+    '''
+        Fixed size buffer of (x, y) points in a NumPy array; once full,
+        the oldest points are overwritten.
+    '''
+    def __init__(self, capacity=4096):
+        self._data = np.empty((capacity, 2))
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, x, y):
+        capacity = len(self._data)
+        self._data[(self._start + self._len) % capacity] = x, y
+        if self._len < capacity:
+            self._len += 1
+        else:
+            self._start = (self._start + 1) % capacity
+
+    def array(self):
+        ''' the points, oldest first, as an array of shape (N, 2)'''
+        idx = (self._start + np.arange(self._len)) % len(self._data)
+        return self._data[idx]
+
+
+class CalibrationCollector(CallbackBase):
+    '''
+        Keep the (x, y) points of the primary stream of calibration scans
+        in memory, in a ``RingBuffer`` per run uid (the last ``max_runs``).
+
+        Parameters
+        ----------
+        x_name, y_name : str
+            the data keys, e.g. the motor and detector names
+    '''
+    def __init__(self, x_name, y_name, capacity=4096, max_runs=20):
+        self.x_name = x_name
+        self.y_name = y_name
+        self.capacity = capacity
+        self.max_runs = max_runs
+        self.runs = OrderedDict()
+        self.last_uid = None
+        self._primary = {}
+
+    def start(self, doc):
+        self.runs[doc['uid']] = RingBuffer(self.capacity)
+        self.last_uid = doc['uid']
+        while len(self.runs) > self.max_runs:
+            self.runs.popitem(last=False)
+
+    def descriptor(self, doc):
+        if doc.get('name', 'primary') == 'primary':
+            self._primary[doc['uid']] = doc['run_start']
+
+    def event(self, doc):
+        buffer = self.runs.get(self._primary.get(doc['descriptor']))
+        data = doc['data']
+        if buffer is not None and self.x_name in data and self.y_name in data:
+            buffer.append(data[self.x_name], data[self.y_name])
+
+    def data(self, uid=None):
+        ''' x and y arrays of a run, the last one by default'''
+        points = self.runs[uid or self.last_uid].array()
+        return points[:, 0], points[:, 1]
+
+
+class EcalFitWorker:
+    '''
+        Fit calibration scans in a worker thread, and plot them later.
+
+        ``fit`` returns a ``concurrent.futures.Future``; plans wait for it
+        with ``wait_for_fit``, which leaves the RunEngine free meanwhile.
+        ``plot`` only queues a fit: the queue is drawn, in one figure, from
+        IPython's main thread once the RunEngine has returned (or on
+        ``draw()``), so a plan never blocks on matplotlib.
+    '''
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._shown = []
+
+    def fit(self, xdata, ydata, sigma=None):
+        return self._executor.submit(guess_and_fit, np.asarray(xdata),
+                                     np.asarray(ydata), sigma)
+
+    def clear(self):
+        ''' start a new figure at the next draw'''
+        with self._lock:
+            self._pending = []
+            self._shown = []
+
+    def plot(self, title, xdata, ydata, result):
+        with self._lock:
+            self._pending.append((title, np.asarray(xdata),
+                                  np.asarray(ydata), result.best_fit))
+
+    def draw(self, *args):
+        with self._lock:
+            if not self._pending:
+                return
+            self._shown.extend(self._pending)
+            self._pending = []
+            shown = list(self._shown)
+        fig = plt.figure('Ecal fits')
+        fig.clf()
+        for i, (title, xdata, ydata, best_fit) in enumerate(shown):
+            order = np.argsort(xdata)
+            xdata, ydata, best_fit = (xdata[order], ydata[order],
+                                      best_fit[order])
+            ax = fig.add_subplot(1, len(shown), i + 1)
+            ax.plot(xdata, ydata, linewidth=0, marker='o', color='b',
+                    label="data")
+            ax.plot(xdata, best_fit, color='r', label="fit")
+            ax.set_title(title)
+        fig.canvas.draw_idle()
+
+
+def wait_for_fit(future):
+    '''
+        Wait for a fit of ``EcalFitWorker`` without blocking the RunEngine,
+        and return it.
+    '''
+    yield from bps.wait_for([lambda: asyncio.wrap_future(future)])
+    return future.result()
+
+
+ecal_worker = EcalFitWorker()
+get_ipython().events.register('post_execute', ecal_worker.draw)
+
+
 def guess_theta_from_reference(wguess, D="Si"):
     '''
         Guess the theta value from the reference.
@@ -132,10 +379,118 @@ def wavelength_from_theta(theta, d):
     '''
     return 2*d*np.sin(np.radians(theta))
 
+
+def wavelength_std_from_theta(theta, theta_std, d):
+    '''
+        The standard error of wavelength_from_theta, given that of theta
+        (both in degrees)
+    '''
+    return 2*d*np.cos(np.radians(theta))*np.radians(theta_std)
+
+
+def _x0_stderr(result):
+    ''' the standard error of a peakfunc fit center, nan if unknown'''
+    stderr = result.params['x0'].stderr
+    return np.nan if stderr is None else stderr
+
+
+def plan_dip_traversal(centers, half_widths, step):
+    '''
+        The positions measuring several dips in a single sweep.
+
+        The windows ``centers`` +/- ``half_widths`` are sampled on one grid
+        of pitch ``step`` (so overlapping windows share their points) and
+        traversed once, from positive to negative: the direction of the
+        other Ecal scans, without a backlash reversal, and the least travel
+        covering all the windows.
+
+        Parameters
+        ----------
+        centers, half_widths : array
+            the predicted dips, and how far around them to look
+        step : float
+            the step between points
+
+        Returns
+        -------
+        positions : array
+            decreasing
+        windows : list of (float, float)
+            the (low, high) limits of each window, in the order of centers
+    '''
+    centers = np.asarray(centers, dtype=float)
+    half_widths = np.broadcast_to(half_widths, centers.shape)
+    windows = [(c - h, c + h) for c, h in zip(centers, half_widths)]
+    indices = np.unique(np.concatenate([
+        np.arange(np.ceil(low / step), np.floor(high / step) + 1)
+        for low, high in windows]))
+    return indices[::-1] * step, windows
+
+
+def fit_wavelength_and_offset(centers, center_stds, d_spacings, signs,
+                              wguess, theta_offset, factor=1):
+    '''
+        Fit the wavelength and theta offset jointly to dip centers.
+
+        Each center is modelled as
+        theta_offset + sign*factor*arcsin(wavelength/(2 d)), in degrees,
+        and weighted by its standard error.
+
+        Parameters
+        ----------
+        centers, center_stds : array
+            the fitted dip centers and their standard errors
+        d_spacings : array
+            the d spacing of each dip
+        signs : array
+            +1 or -1, the side of each dip
+        wguess, theta_offset : float
+            the starting values
+        factor : int, optional
+            1 if the motor is theta, 2 if it is two theta
+
+        Returns
+        -------
+        result : dict
+            wavelength, theta_offset, their standard errors
+            (wavelength_std, theta_offset_std), the reduced chi square
+            (redchi), and residuals (center - model, per dip)
+    '''
+    centers, center_stds, d_spacings, signs = (
+        np.asarray(a, dtype=float)
+        for a in (centers, center_stds, d_spacings, signs))
+
+    def model(p):
+        return p[1] + signs * factor * np.degrees(
+            np.arcsin(p[0] / (2 * d_spacings)))
+
+    def residuals(p):
+        return (centers - model(p)) / center_stds
+
+    def jacobian(p):
+        s = p[0] / (2 * d_spacings)
+        dtheta = signs * factor * np.degrees(
+            1 / (2 * d_spacings * np.sqrt(1 - s**2)))
+        return -np.column_stack([dtheta, np.ones_like(s)]) / center_stds[:, None]
+
+    res = least_squares(residuals, [wguess, theta_offset], jac=jacobian,
+                        method='lm')
+    dof = len(centers) - 2
+    redchi = np.sum(res.fun**2) / dof if dof > 0 else np.nan
+    covar = np.linalg.inv(res.jac.T @ res.jac)
+    if dof > 0:
+        # like lmfit, scale the errors to the scatter actually seen
+        covar = covar * redchi
+    stds = np.sqrt(np.diag(covar))
+    return dict(wavelength=res.x[0], theta_offset=res.x[1],
+                wavelength_std=stds[0], theta_offset_std=stds[1],
+                redchi=redchi, residuals=centers - model(res.x))
+
+
 # New calibration scan plan
 def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=120, D='Si', detector_name='sc_chan1',
               theta_offset=-35.26, nsigma_fine=.1, nsigma_range=5,
-              output_file="result.csv", motor_type='th'):
+              output_file="result.csv", motor_type='th', plot=True):
     '''
         This is the new Ecal scan for dips.
             We should treat peaks separately to simplify matters (leaves for
@@ -145,6 +500,8 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
         This algorithm will search for a peak within a certain theta range
             The theta range is determined from the wavelength guess
 
+        Once accepted, the result is recorded in ``calibration_store``.
+
         Parameters
         ----------
         wguess : the guessed wavelength
@@ -175,6 +532,9 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
             the coarse scan
         motor_type : str, optional
             the type of motor used, ether "th" (theta) or "tth"(two-theta)
+        plot : bool, optional
+            plot the scans live and the fits (once the plan has returned);
+            False for headless calibrations
 
         Example
         -------
@@ -200,15 +560,16 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
                                                 peak_guesses[1]))
 
 
-    # set up the live Plotting
-    fig = plt.figure(detector_name)
-    fig.clf();
-    ax = plt.gca();
-
-    #detector_name = detectors[0].name
-
-    # set up a live plotter
-    lp = LivePlot(detector_name, x=motor.name, marker='o', ax=ax)
+    # the scans are kept by the collector, and fit by ecal_worker
+    collector = CalibrationCollector(motor.name, detector_name)
+    subs = [collector]
+    ecal_worker.clear()
+    if plot:
+        # set up the live Plotting
+        fig = plt.figure(detector_name)
+        fig.clf();
+        ax = plt.gca();
+        subs.append(LivePlot(detector_name, x=motor.name, marker='o', ax=ax))
 
     xdata_total = list()
     ydata_total = list()
@@ -224,26 +585,19 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
         # reverse to go negative
         start, stop = stop, start
         print("Trying to a guess. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
-        yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
+        yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), subs)
         # TODO : check if a peak was found here
         # (can use ispeak(... , sdev=2)
         # find the position c1 in terms of theta
 
-        xdata = lp.x_data
-        ydata = lp.y_data
-
-        peakmodel = Model(peakfunc, independent_vars=['x'])
-        init_guess = guess(xdata, ydata, sigma=coarse_step/10.)
-        res = peakmodel.fit(data=ydata, x=xdata, params=init_guess)
+        xdata, ydata = collector.data()
+        res = yield from wait_for_fit(
+            ecal_worker.fit(xdata, ydata, sigma=coarse_step/10.))
         fitted_sigma = res.best_values['sigma']
 
-        print("guess: {}".format(init_guess))
-
-        plt.figure('fitting coarse {}'.format(cnt));plt.clf()
-        plt.plot(lp.x_data, lp.y_data, linewidth=0, marker='o', color='b', label="data")
-        plt.plot(lp.x_data, res.best_fit, color='r', label="fit")
-        plt.plot(init_guess['x0'].value, init_guess['amplitude'].value +
-                 init_guess['intercept'].value, 'ro')
+        print("guess: {}".format(res.init_params))
+        if plot:
+            ecal_worker.plot('fitting coarse {}'.format(cnt), xdata, ydata, res)
 
         # best guess of center position
         new_theta_guess = res.best_values['x0']
@@ -254,20 +608,13 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
         # reverse to go negative
         start, stop = stop, start
         print("Trying to a guess. Moving {} from {} to {} in {} steps".format(motor.name, start, stop, npoints))
-        yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), lp)
+        yield from bpp.subs_wrapper(bp.scan(detectors, motor, start, stop, npoints), subs)
 
-        xdata = lp.x_data
-        ydata = lp.y_data
-
-        peakmodel = Model(peakfunc, independent_vars=['x'])
-        init_guess = guess(xdata, ydata, sigma=coarse_step/10.)
-        res = peakmodel.fit(data=ydata, x=xdata, params=init_guess)
-
-        plt.figure('fitting fine {}'.format(cnt));plt.clf()
-        plt.plot(lp.x_data, lp.y_data, linewidth=0, marker='o', color='b', label="data")
-        plt.plot(lp.x_data, res.best_fit, color='r', label="fit")
-        plt.plot(init_guess['x0'].value, init_guess['amplitude'].value +
-                 init_guess['intercept'].value, 'ro')
+        xdata, ydata = collector.data()
+        res = yield from wait_for_fit(
+            ecal_worker.fit(xdata, ydata, sigma=coarse_step/10.))
+        if plot:
+            ecal_worker.plot('fitting fine {}'.format(cnt), xdata, ydata, res)
 
         results_list.append(res)
 
@@ -287,20 +634,322 @@ def Ecal(wguess, detectors=[sc], motor=th_cal, coarse_step=.0012, coarse_nsteps=
     # if th, factor =1 , if tth factor=2 since th = tth/2
     fitted_wavelength = wavelength_from_theta(average_peak_theta/factor,
                                               D_SPACINGS[D][0])
-    print("Fitted wavelength is {} angs".format(fitted_wavelength))
+    # half the difference (or the mean) of the two centers
+    theta_std = np.hypot(_x0_stderr(results_list[0]),
+                         _x0_stderr(results_list[1]))*.5
+    wavelength_std = wavelength_std_from_theta(average_peak_theta/factor,
+                                               theta_std/factor,
+                                               D_SPACINGS[D][0])
+    print("Fitted wavelength is {} +/- {} angs".format(fitted_wavelength,
+                                                       wavelength_std))
     print("Are you happy with results? (y/n)")
     prompt_result = yield from bps.input_plan(">")
     if prompt_result.lower() == "y":
-        print("ok, not finalizing. Please run this again")
-    else:
         print("Great. Finalizing the Ecal...")
+        calibration_store.record(fitted_wavelength, wavelength_std,
+                                 new_theta_offset, theta_std, reference=D,
+                                 method='Ecal', uids=list(collector.runs))
         #yield from finalize_ecal()
+    else:
+        print("ok, not finalizing. Please run this again")
 
     # in case we want access to the results list
     myresult.results_list = results_list
     myresult.wavelength = fitted_wavelength
 
 
+def Ecal_adaptive(wguess, detectors=[sc], motor=th_cal, D='Si',
+                  detector_name='sc_chan1', theta_offset=-35.26, sigma=.004,
+                  search_range=.144, search_step=None, center_tol=1e-4,
+                  max_points=60, backlash=.01, motor_type='th', plot=True,
+                  md=None):
+    '''
+        Energy calibration on the first pair of dips, choosing every point
+        from a live fit.
+
+        Each dip is first searched for by stepping ``search_step`` through
+        +/- ``search_range`` around its predicted position, stopping as soon
+        as it has been crossed. Then every next point is the position most
+        informative about the dip center (see ``AdaptiveDipFit``), until
+        the center is known to ``center_tol`` or ``max_points`` were taken.
+        With the defaults this takes some 20-25 points per dip, where
+        ``Ecal`` takes over a hundred. The result is recorded in
+        ``calibration_store``.
+
+        Parameters
+        ----------
+        wguess : the guessed wavelength
+        detectors : list, optional
+            list of detectors. Defaults to [sc] detector
+        motor : motor, optional
+            the motor to scan on (th_cal). Defaults to th_cal
+        D : string, optional
+            the reference sample to use for the calculation of the d spacings
+            Defaults to "Si"
+        detector_name : str, optional
+            the name of the detector
+        theta_offset : float, optional
+            the offset of theta zero estimated from the sample
+        sigma : float, optional
+            a guess of the dip width, in motor units
+        search_range : float, optional
+            how far from the predicted position to search for a dip
+        search_step : float, optional
+            step of the search, defaults to 2*sigma
+        center_tol : float, optional
+            the standard error of the dip centers to reach
+        max_points : int, optional
+            the most points to take per dip
+        backlash : float, optional
+            every position is approached from above, from at least this far
+        motor_type : str, optional
+            the type of motor used, ether "th" (theta) or "tth"(two-theta)
+        plot : bool, optional
+            plot the fits once the plan has returned
+
+        Example
+        -------
+        >>> RE(Ecal_adaptive(.1867))
+    '''
+    global myresult
+    factor = dict(th=1, tth=2)[motor_type]
+    if search_step is None:
+        search_step = 2 * sigma
+    cen_guess = factor * guess_theta_from_reference(wguess, D=D)[0]
+    fits = []
+    _md = {'plan_name': 'Ecal_adaptive', 'wguess': wguess, 'D': D,
+           'detectors': [det.name for det in detectors],
+           'motors': [motor.name]}
+    _md.update(md or {})
+    position = [None]
+    uids = []
+    ecal_worker.clear()
+
+    def measure(fit, x):
+        if position[0] is not None and x > position[0]:
+            yield from bps.mv(motor, x + backlash)
+        yield from bps.mv(motor, x)
+        position[0] = x
+        reading = yield from bps.trigger_and_read(list(detectors) + [motor])
+        fit.add(reading[motor.name]['value'], reading[detector_name]['value'])
+
+    @bpp.stage_decorator(list(detectors) + [motor])
+    @bpp.run_decorator(md=_md)
+    def inner():
+        for theta_guess in (theta_offset + cen_guess, theta_offset - cen_guess):
+            fit = AdaptiveDipFit(np.arange(theta_guess - search_range,
+                                           theta_guess + search_range,
+                                           sigma / 4), sigma)
+            # search from positive to negative, the direction without backlash
+            for x in np.arange(theta_guess + search_range,
+                               theta_guess - search_range, -search_step):
+                yield from measure(fit, x)
+                if fit.found():
+                    break
+            while len(fit.x) < max_points and fit.center_std > center_tol:
+                yield from measure(fit, fit.next_position())
+            fits.append(fit)
+            if fit.ok:
+                print("Found center at {} +/- {} after {} points".format(
+                    fit.center, fit.center_std, len(fit.x)))
+            else:
+                print("WARNING: no usable fit of dip {} after {} points"
+                      .format(len(fits), len(fit.x)))
+            if plot and fit.result is not None:
+                ecal_worker.plot('dip {}'.format(len(fits)), fit.x, fit.y,
+                                 fit.result)
+
+    yield from bpp.subs_wrapper(
+        inner(), {'start': lambda name, doc: uids.append(doc['uid'])})
+
+    failed = [i for i, fit in enumerate(fits, start=1) if not fit.ok]
+    if failed:
+        raise RuntimeError("No usable fit of dip(s) {}, the calibration is "
+                           "not recorded".format(failed))
+
+    new_theta_offset = (fits[0].center + fits[1].center) * .5
+    average_peak_theta = np.abs(fits[0].center - fits[1].center) * .5
+    theta_std = np.hypot(fits[0].center_std, fits[1].center_std) * .5
+    print("new theta offset : {} deg".format(new_theta_offset))
+    print("average peak theta: {} deg".format(average_peak_theta))
+    fitted_wavelength = wavelength_from_theta(average_peak_theta / factor,
+                                              D_SPACINGS[D][0])
+    wavelength_std = wavelength_std_from_theta(
+        average_peak_theta / factor, theta_std / factor, D_SPACINGS[D][0])
+    print("Fitted wavelength is {} +/- {} angs".format(fitted_wavelength,
+                                                       wavelength_std))
+    calibration_store.record(fitted_wavelength, wavelength_std,
+                             new_theta_offset, theta_std, reference=D,
+                             method='Ecal_adaptive', uids=uids)
+
+    myresult.results_list = [fit.result for fit in fits]
+    myresult.wavelength = fitted_wavelength
+    return fitted_wavelength
+
+
+def Ecal_multi(wguess, detectors=[sc], motor=th_cal, D='Si',
+               detector_name='sc_chan1', theta_offset=-35.26,
+               reflections=None, sigma=.004, step=None, offset_range=.05,
+               wavelength_range=.005, backlash=.01, motor_type='th',
+               plot=True, md=None):
+    '''
+        Energy calibration on the dip pairs of all the reflections at once.
+
+        The dips predicted from ``wguess`` on both sides of
+        ``theta_offset`` are measured in a single sweep of the motor (see
+        ``plan_dip_traversal``) and fit one by one, then the wavelength and
+        the theta offset are fit jointly to all their centers (see
+        ``fit_wavelength_and_offset``). The residual of every dip is
+        printed, so a bad reflection stands out. The result is recorded in
+        ``calibration_store``.
+
+        Parameters
+        ----------
+        wguess : the guessed wavelength
+        detectors : list, optional
+            list of detectors. Defaults to [sc] detector
+        motor : motor, optional
+            the motor to scan on (th_cal). Defaults to th_cal
+        D : string, optional
+            the reference sample to use for the calculation of the d spacings
+            Defaults to "Si"
+        detector_name : str, optional
+            the name of the detector
+        theta_offset : float, optional
+            the offset of theta zero estimated from the sample
+        reflections : list of int, optional
+            the indices of the d spacings of D to use, defaults to all of
+            them within the motor limits
+        sigma : float, optional
+            a guess of the dip width, in motor units
+        step : float, optional
+            the step between points, defaults to sigma/2
+        offset_range : float, optional
+            how far off theta_offset may be, in motor units
+        wavelength_range : float, optional
+            how far off wguess may be, relative. Each dip is looked for
+            within offset_range plus the shift this causes to it.
+        backlash : float, optional
+            the sweep is started from at least this far above
+        motor_type : str, optional
+            the type of motor used, ether "th" (theta) or "tth"(two-theta)
+        plot : bool, optional
+            plot the scan live and the fits (once the plan has returned)
+
+        Example
+        -------
+        >>> RE(Ecal_multi(.1867))
+    '''
+    global myresult
+    factor = dict(th=1, tth=2)[motor_type]
+    if step is None:
+        step = sigma / 2
+    d_spacings = D_SPACINGS[D]
+    if reflections is None:
+        reflections = np.arange(len(d_spacings))
+    reflections = np.asarray(reflections)
+    cen_guesses = factor * guess_theta_from_reference(wguess, D=D)[reflections]
+    signs = np.repeat([[1, -1]], len(reflections), axis=0).ravel()
+    reflections = np.repeat(reflections, 2)
+    centers = theta_offset + signs * np.repeat(cen_guesses, 2)
+    # d(theta) = tan(theta) d(wavelength)/wavelength
+    half_widths = offset_range + wavelength_range * factor * np.degrees(
+        np.tan(np.radians(np.repeat(cen_guesses, 2) / factor)))
+
+    low, high = getattr(motor, 'limits', (0, 0))
+    if low < high:
+        inside = (centers - half_widths >= low) & (centers + half_widths <= high)
+        for i in np.flatnonzero(~inside):
+            print("Skipping the dip expected at {}, beyond the limits of {}"
+                  .format(centers[i], motor.name))
+        if not inside.any():
+            raise ValueError("All the dips are beyond the limits of {} "
+                             "({}, {})".format(motor.name, low, high))
+        centers, half_widths = centers[inside], half_widths[inside]
+        signs, reflections = signs[inside], reflections[inside]
+
+    positions, windows = plan_dip_traversal(centers, half_widths, step)
+    print("Measuring {} dips in {} points, moving {} from {} to {}".format(
+        len(centers), len(positions), motor.name, positions[0],
+        positions[-1]))
+
+    collector = CalibrationCollector(motor.name, detector_name)
+    subs = [collector]
+    ecal_worker.clear()
+    if plot:
+        fig = plt.figure(detector_name)
+        fig.clf();
+        ax = plt.gca();
+        subs.append(LivePlot(detector_name, x=motor.name, marker='o', ax=ax))
+
+    _md = {'plan_name': 'Ecal_multi', 'wguess': wguess, 'D': D,
+           'reflections': [int(i) for i in reflections[::2]]}
+    _md.update(md or {})
+    # approach the start from above, as every point after it
+    yield from bps.mv(motor, positions[0] + backlash)
+    yield from bpp.subs_wrapper(
+        bp.list_scan(detectors, motor, list(positions), md=_md), subs)
+
+    xdata, ydata = collector.data()
+    futures = []
+    for low, high in windows:
+        inside = (xdata >= low - step / 2) & (xdata <= high + step / 2)
+        futures.append((xdata[inside], ydata[inside],
+                        ecal_worker.fit(xdata[inside], ydata[inside],
+                                        sigma=sigma)))
+    results_list = []
+    for i, (x, y, future) in enumerate(futures):
+        res = yield from wait_for_fit(future)
+        if plot:
+            ecal_worker.plot('dip {} ({}{})'.format(
+                i + 1, d_spacings[reflections[i]].round(4),
+                '+-'[signs[i] < 0]), x, y, res)
+        results_list.append(res)
+
+    # dips the fit could not pin down carry no weight
+    fitted = np.array([res.success and res.params['x0'].stderr is not None
+                       and np.isfinite(res.params['x0'].stderr)
+                       for res in results_list])
+    for i in np.flatnonzero(~fitted):
+        print("No dip found around {}, leaving it out".format(centers[i]))
+    if fitted.sum() < 2:
+        raise RuntimeError("Found only {} dips, too few to fit the "
+                           "wavelength and offset".format(fitted.sum()))
+    dip_centers = np.array([res.best_values['x0'] for res in results_list])
+    dip_stds = np.array([res.params['x0'].stderr if ok else np.nan
+                         for res, ok in zip(results_list, fitted)])
+    joint = fit_wavelength_and_offset(
+        dip_centers[fitted], dip_stds[fitted],
+        d_spacings[reflections[fitted]], signs[fitted], wguess, theta_offset,
+        factor=factor)
+    residuals = np.full(len(centers), np.nan)
+    residuals[fitted] = joint['residuals']
+
+    print("{:>8} {:>4} {:>12} {:>10} {:>10} {:>7}".format(
+        'd', 'side', 'center', 'std', 'residual', 'sigmas'))
+    for i in range(len(centers)):
+        print("{:8.4f} {:>4} {:12.6f} {:10.2e} {:10.2e} {:7.2f}".format(
+            d_spacings[reflections[i]], '+-'[signs[i] < 0], dip_centers[i],
+            dip_stds[i], residuals[i], residuals[i] / dip_stds[i]))
+    print("new theta offset : {} +/- {} deg".format(
+        joint['theta_offset'], joint['theta_offset_std']))
+    print("Fitted wavelength is {} +/- {} angs (reduced chi square {:.2f})"
+          .format(joint['wavelength'], joint['wavelength_std'],
+                  joint['redchi']))
+
+    calibration_store.record(joint['wavelength'], joint['wavelength_std'],
+                             joint['theta_offset'], joint['theta_offset_std'],
+                             reference=D, method='Ecal_multi',
+                             uids=list(collector.runs))
+
+    myresult.results_list = results_list
+    myresult.wavelength = joint['wavelength']
+    myresult.wavelength_std = joint['wavelength_std']
+    myresult.theta_offset = joint['theta_offset']
+    myresult.residuals = residuals
+    return joint['wavelength']
+
+
 class MyResult:
     pass
 
@@ -0,0 +1,5 @@
+# Connect the devices every xpdAcq session uses in one go, with a single
+# timeout, rather than one at a time on first use. The other devices stay
+# lazy; bulk_connect() with no arguments connects all of them.
+
+bulk_connect([pe3c, shctl1, cs700, fb, ring_current], timeout=5)
@@ -60,10 +60,6 @@ xrun.md['beamline_config'] = beamline_config
 # insert header to db, either simulated or real
 xrun.subscribe(db.insert, 'all')
 
-# robot command
-xrun.register_command('load_sample', _load_sample)
-xrun.register_command('unload_sample', _unload_sample)
-
 if bt:
     xrun.beamtime = bt
 
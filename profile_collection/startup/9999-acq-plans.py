@@ -4,6 +4,7 @@
 from xpdacq.beamtime import _configure_area_det
 import os
 import numpy as np
+import pandas as pd
 import itertools
 from bluesky.plans import (scan, count, list_scan, adaptive_scan)
 from bluesky.preprocessors import subs_wrapper, reset_positions_wrapper
@@ -57,10 +58,14 @@ def Gas_Plan(gas_in = 'He', liveplot_key=None, totExpTime = 5, num_exp = 1, dela
     _configure_area_det(totExpTime)   # 5 secs exposuretime
 
     ## ScanPlan you need
-    plan = bp.count([pe1c, gas.current_gas, rga], num=num_exp, delay= delay)
+    ## the gas and the RGA are recorded at their own rate, in the
+    ## 'gas_monitor' and 'rga_monitor' streams, not at every frame
+    plan = bp.count([pe1c], num=num_exp, delay= delay)
+    plan = monitor_streams_wrapper(plan, [gas_stream(), rga_stream()])
 
     #plan = bpp.subs_wrapper(plan, LiveTable([xpd_configuration['area_det'], rga]))   # give you LiveTable
-    plan = bpp.subs_wrapper(plan, LiveTable([xpd_configuration['area_det'], gas.current_gas, rga]))
+    plan = bpp.subs_wrapper(plan, [LiveTable([xpd_configuration['area_det']]),
+                                   LiveTable([rga], stream_name='rga_monitor')])
     if liveplot_key and isinstance(liveplot_key, str):
         plan =  bpp.subs_wrapper(plan, LivePlot(liveplot_key))
 
@@ -71,7 +76,9 @@ def run_and_save(sample_num = 0):
     file_name = data_dir + "sample_num_" + str(sample_num) + ".csv"
     xrun(sample_num, gas_plan)
     h = db[-1]
-    tb = h.table()
+    # every RGA reading, with the gas flowing at that time
+    tb = pd.merge_asof(h.table('rga_monitor'), h.table('gas_monitor'),
+                       on='time')
     tb.to_csv(path_or_buf =file_name, columns = ['time', 'gas_current_gas', 'rga_mass1',
                               'rga_mass2', 'rga_mass3', 'rga_mass4', 'rga_mass5',
                               'rga_mass6', 'rga_mass7', 'rga_mass8', 'rga_mass9'])
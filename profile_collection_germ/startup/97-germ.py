@@ -3,9 +3,15 @@ from databroker.headersource.sqlite import MDS
 from databroker import Broker
 import bluesky as bs
 import bluesky.plans as bp
+from bluesky.callbacks import CallbackBase
 
 from pathlib import Path
+import bisect
+import datetime
+import hashlib
+import json
 import os
+import time
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib.widgets import SpanSelector
@@ -61,10 +67,13 @@ def linear(x, a, b):
     return a*x+b
 
 
-def fit_all_channels(data, plot=True):
+def fit_all_channels_lmfit(data, plot=True):
     '''
         This fits the 2D binned data and fits each column to three peaks.
         This returns the positions of the peaks in the array (not energy specific)
+
+        This is the original column-by-column lmfit version, kept as the
+        reference for ``fit_all_channels``.
     '''
     if plot:
         fig, ax = plt.subplots()
@@ -103,6 +112,254 @@ def fit_all_channels(data, plot=True):
     return g1_cen_list, g2_cen_list, g3_cen_list
 
 
+# parameters of the batched fitter are (area, center, sigma) per peak
+
+
+def _gaussian_terms(x, p):
+    """evaluate each gaussian of a (channels, 3*npeaks) parameter array
+
+    Returns the per-peak curves, shape (channels, npeaks, len(x)), and the
+    unit-area profiles they are built from.
+    """
+    area = p[:, 0::3, None]
+    center = p[:, 1::3, None]
+    sigma = p[:, 2::3, None]
+    prof = (np.exp(-(x - center)**2 / (2*sigma**2)) /
+            (np.sqrt(2*np.pi)*sigma))
+    return area*prof, prof
+
+
+def _gaussian_jacobian(x, p, g, prof):
+    """analytic jacobian of the summed gaussians, shape (channels, len(x), nparams)"""
+    center = p[:, 1::3, None]
+    sigma = p[:, 2::3, None]
+    dx = x - center
+    d_center = g*dx/sigma**2
+    d_sigma = g*(dx**2/sigma**3 - 1/sigma)
+    # (channels, npeaks, 3, len(x)) -> (channels, 3*npeaks, len(x))
+    jac = np.stack([prof, d_center, d_sigma], axis=2)
+    jac = jac.reshape(p.shape[0], p.shape[1], -1)
+    return jac.transpose(0, 2, 1)
+
+
+def batch_fit_gaussians(data, p0, lower, upper, max_iter=100, tol=1e-8):
+    """Levenberg-Marquardt fit of a sum of gaussians to every column at once
+
+    All channels are iterated together as stacked numpy arrays; each channel
+    keeps its own damping factor and stops once it has converged.  Bounds
+    are enforced by clipping the trial step.
+
+    Parameters
+    ----------
+    data : ndarray
+        shape (bins, channels), one spectrum per column
+    p0, lower, upper : ndarray
+        shape (channels, 3*npeaks), parameters ordered (area, center, sigma)
+        per peak.  Use +/-np.inf for unbounded parameters.
+    max_iter : int, optional
+        maximum number of LM iterations
+    tol : float, optional
+        relative change in chi-square below which a channel is converged
+
+    Returns
+    -------
+    params : ndarray
+        shape (channels, 3*npeaks), the fitted parameters
+    chisq : ndarray
+        shape (channels,), the final sum of squared residuals
+    """
+    y = np.asarray(data, dtype=float).T
+    x = np.arange(y.shape[1], dtype=float)
+    p = np.clip(np.array(p0, dtype=float), lower, upper)
+    nchan, npar = p.shape
+
+    g, _ = _gaussian_terms(x, p)
+    resid = y - g.sum(axis=1)
+    chisq = np.einsum('ij,ij->i', resid, resid)
+    lam = np.full(nchan, 1e-3)
+    active = np.ones(nchan, dtype=bool)
+    diag = np.arange(npar)
+
+    for _ in range(max_iter):
+        idx, = np.nonzero(active)
+        if not len(idx):
+            break
+        pa = p[idx]
+        ga, profa = _gaussian_terms(x, pa)
+        jac = _gaussian_jacobian(x, pa, ga, profa)
+        jtj = np.einsum('cmi,cmj->cij', jac, jac)
+        jtr = np.einsum('cmi,cm->ci', jac, resid[idx])
+
+        damped = jtj.copy()
+        damped[:, diag, diag] += lam[idx, None]*(jtj[:, diag, diag] + 1e-12)
+        step = np.linalg.solve(damped, jtr[..., None])[..., 0]
+        trial = np.clip(pa + step, lower[idx], upper[idx])
+
+        gt, _ = _gaussian_terms(x, trial)
+        resid_t = y[idx] - gt.sum(axis=1)
+        chisq_t = np.einsum('ij,ij->i', resid_t, resid_t)
+
+        better = chisq_t < chisq[idx]
+        acc = idx[better]
+        rel = (chisq[acc] - chisq_t[better])/np.maximum(chisq[acc], 1e-300)
+        p[acc] = trial[better]
+        resid[acc] = resid_t[better]
+        chisq[acc] = chisq_t[better]
+        lam[acc] = np.maximum(lam[acc]/10, 1e-12)
+        rej = idx[~better]
+        lam[rej] *= 10
+
+        # converged: negligible improvement, or no improvement even with
+        # (almost) pure gradient descent steps
+        active[acc[rel < tol]] = False
+        active[rej[lam[rej] > 1e10]] = False
+
+    return p, chisq
+
+
+def _initial_three_peak_params(data):
+    """initial guesses and bounds for the three peak calibration fit
+
+    Uses the same search windows and bounds as ``fit_all_channels_lmfit``,
+    but guesses the areas from the peak heights.
+    """
+    nchan = data.shape[1]
+    chans = np.arange(nchan)
+    g1_cen = 800 + np.argmax(data[800:1400], axis=0)
+    g3_cen = 3100 + np.argmax(data[3100:3900], axis=0)
+    g2_cen = np.minimum(g1_cen + 150, data.shape[0] - 1)
+    sigma = np.full(nchan, 10.)
+
+    def area(cen):
+        return np.maximum(data[cen, chans]*sigma*np.sqrt(2*np.pi), 1.)
+
+    p0 = np.column_stack([area(g1_cen), g1_cen, sigma,
+                          area(g2_cen), g2_cen, sigma,
+                          area(g3_cen), g3_cen, sigma]).astype(float)
+    lower = np.full_like(p0, -np.inf)
+    upper = np.full_like(p0, np.inf)
+    lower[:, 1], upper[:, 1] = g1_cen - 30, g1_cen + 30
+    lower[:, 2], upper[:, 2] = 5, 40
+    lower[:, 5], upper[:, 5] = 5, 40
+    # keep the last sigma positive so the model stays defined
+    lower[:, 8] = 1e-3
+    return p0, lower, upper
+
+
+def _fit_channel_block(args):
+    return batch_fit_gaussians(*args)
+
+
+def fit_all_channels(data, plot=False, processes=None, chunksize=64,
+                     return_params=False):
+    '''
+        This fits the 2D binned data and fits each column to three peaks.
+        This returns the positions of the peaks in the array (not energy specific)
+
+        All columns are fit together by ``batch_fit_gaussians``, in blocks
+        of ``chunksize`` channels to bound memory.  If ``processes`` is
+        given, the blocks are farmed out to a process pool of that size.
+        Plotting is opt-in and done once at the end (``plot_channel_fits``).
+        With ``return_params`` the full (channels, 9) parameter array is
+        returned as well.
+    '''
+    data = np.asarray(data, dtype=float)
+    p0, lower, upper = _initial_three_peak_params(data)
+    blocks = [(data[:, i:i+chunksize], p0[i:i+chunksize],
+               lower[i:i+chunksize], upper[i:i+chunksize])
+              for i in range(0, data.shape[1], chunksize)]
+    if processes:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as ex:
+            results = list(ex.map(_fit_channel_block, blocks))
+    else:
+        results = [_fit_channel_block(b) for b in blocks]
+    params = np.concatenate([r[0] for r in results])
+
+    if plot:
+        plot_channel_fits(data, params)
+
+    cens = params[:, 1], params[:, 4], params[:, 7]
+    if return_params:
+        return cens, params
+    return cens
+
+
+def plot_channel_fits(data, params, channels=None, ax=None):
+    """Plot data and best fit for a few channels of a batched fit
+
+    Parameters
+    ----------
+    data : ndarray
+        shape (bins, channels), as passed to the fitter
+    params : ndarray
+        shape (channels, 3*npeaks), as returned by ``batch_fit_gaussians``
+    channels : iterable of int, optional
+        channels to plot, defaults to 5 evenly spaced ones
+    ax : Axes, optional
+    """
+    if ax is None:
+        fig, ax = plt.subplots()
+    if channels is None:
+        channels = np.linspace(0, data.shape[1] - 1, 5).astype(int)
+    channels = np.asarray(channels)
+    x = np.arange(data.shape[0])
+    g, _ = _gaussian_terms(x, params[channels])
+    for c, fit in zip(channels, g.sum(axis=1)):
+        line, = ax.plot(x, data[:, c], label="data {}".format(c))
+        ax.plot(x, fit, color=line.get_color(), linestyle='--')
+    ax.legend()
+    ax.figure.canvas.draw_idle()
+    return ax
+
+
+def make_synthetic_heatmap(shape=(4096, 384), seed=0):
+    """Fake calibration heatmap with three noisy peaks per channel
+
+    Returns the heatmap and the true (g1, g2, g3) centers.
+    """
+    rs = np.random.RandomState(seed)
+    bins, nchan = shape
+    x = np.arange(bins)[:, None]
+    g1 = 1100 + rs.uniform(-50, 50, nchan)
+    g2 = g1 + 140
+    g3 = 3500 + rs.uniform(-100, 100, nchan)
+    sig = rs.uniform(8, 15, (3, nchan))
+    im = (gaussian(x, 50000, g1, sig[0]) +
+          gaussian(x, 10000, g2, sig[1]) +
+          gaussian(x, 30000, g3, sig[2]))
+    return rs.poisson(im + 1).astype(float), (g1, g2, g3)
+
+
+def benchmark_fit_all_channels(shape=(4096, 384), processes=None,
+                               lmfit_channels=16, seed=0):
+    """Compare ``fit_all_channels`` to the per-column lmfit loop
+
+    The lmfit loop is only run on the first ``lmfit_channels`` columns and
+    its time is extrapolated to all of them, since the full loop takes
+    minutes.
+    """
+    import time
+    im, truth = make_synthetic_heatmap(shape, seed=seed)
+
+    t0 = time.time()
+    cens = np.array(fit_all_channels(im, processes=processes))
+    t_batch = time.time() - t0
+
+    t0 = time.time()
+    ref = np.array(fit_all_channels_lmfit(im[:, :lmfit_channels],
+                                          plot=False))
+    t_lmfit = (time.time() - t0)*shape[1]/lmfit_channels
+
+    err = np.abs(cens - np.array(truth)).max()
+    diff = np.abs(cens[:, :lmfit_channels] - ref).max()
+    print("batched fit      : {:.2f} s".format(t_batch))
+    print("lmfit loop (est.): {:.2f} s".format(t_lmfit))
+    print("max |center - truth| : {:.3f} bins".format(err))
+    print("max |batched - lmfit|: {:.3f} bins".format(diff))
+    return {'batch': t_batch, 'lmfit': t_lmfit, 'error': err, 'diff': diff}
+
+
 def get_calibration_value(cen_data, y):
     """Linear regression to calculate calibration based on bin center and energy value.
         Assumes data comes from the fit run on mars_heatmap code for three peaks.
@@ -128,72 +385,324 @@ def get_calibration_value(cen_data, y):
         shape [2, number of data], First data is slope and
         the second is intercept.
     """
-    from scipy.stats import linregress
-    # shape is [number of channels, 2]
-    cal_val = np.zeros([2, cen_data.shape[1]])
-    for i in range(cen_data.shape[1]):
-        out = linregress(cen_data[:, i], y)
-        cal_val[0, i] = out[0]
-        cal_val[1, i] = out[1]
-    return cal_val
+    # closed form least squares for all channels at once
+    x = np.asarray(cen_data, dtype=float)
+    y = np.asarray(y, dtype=float)[:, None]
+    dx = x - x.mean(axis=0)
+    dy = y - y.mean()
+    slope = (dx*dy).sum(axis=0)/(dx**2).sum(axis=0)
+    intercept = y.mean() - slope*x.mean(axis=0)
+    return np.vstack([slope, intercept])
+
+
+# the MARS strip detector: 12 chips of 32 channels, 12-bit ADC
+N_CHANNELS = 12*32
+N_ADC = 4096
+
+
+def channel_index(chip, chan):
+    '''flat strip index (0-383) of each photon'''
+    return np.asarray(chip, dtype=int)*32 + np.asarray(chan, dtype=int)
+
+
+def _add_counts(line, bin_ind, chan_ind):
+    '''add one count per (bin, channel) pair to a 2D histogram in place'''
+    if len(bin_ind) > line.size // 16:
+        flat = bin_ind*line.shape[1] + chan_ind
+        line += np.bincount(flat, minlength=line.size).reshape(line.shape)
+    else:
+        # cheaper than a full size bincount for sparse events
+        np.add.at(line, (bin_ind, chan_ind), 1)
+
+
+def accumulate_mars_heatmap(line, data, corr_mat=None, minv=0, maxv=None,
+                            thresh=None):
+    '''Add the photons of one event to a (bins, channels) heatmap in place
+
+    Photons are binned on raw ADC value (``germ_pd``), or on energy if a
+    calibration matrix ``corr_mat`` (shape [2, 384]: slope, intercept) is
+    given.  The bins evenly span [minv, maxv], the last bin including its
+    right edge like ``np.histogram``.  By default there is one bin per ADC
+    value.
+
+    Parameters
+    ----------
+    line : ndarray
+        shape (bins, 384), updated in place
+    data : dict
+        the event data, needs 'germ_chip', 'germ_chan' and 'germ_pd'
+    corr_mat : ndarray, optional
+        calibration matrix
+    minv, maxv : float, optional
+        range of the bins, maxv defaults to the number of bins
+    thresh : float, optional
+        if given, only count photons with ``germ_pd > thresh``
+
+    Returns
+    -------
+    line : ndarray
+    '''
+    nbins = line.shape[0]
+    if maxv is None:
+        maxv = nbins
+    chan_ind = channel_index(data['germ_chip'], data['germ_chan'])
+    gpd = np.asarray(data['germ_pd'], dtype=int)
+    if thresh is not None:
+        keep = gpd > thresh
+        chan_ind, gpd = chan_ind[keep], gpd[keep]
+    if corr_mat is None:
+        bin_ind = _bin_index(gpd, minv, maxv, nbins)
+    else:
+        bin_ind = energy_bin_lut(corr_mat, minv, maxv, nbins)[chan_ind, gpd]
+    good = bin_ind >= 0
+    _add_counts(line, bin_ind[good], chan_ind[good])
+    return line
+
+
+def _bin_index(val, minv, maxv, nbins):
+    '''index of the [minv, maxv] bin holding each value, -1 if outside'''
+    bin_ind = np.floor((val - minv)*(nbins/(maxv - minv))).astype(int)
+    bin_ind[val == maxv] = nbins - 1
+    bin_ind[(bin_ind < 0) | (bin_ind >= nbins)] = -1
+    return bin_ind
+
+
+# energy_bin_lut cache, keyed on (calibration digest, minv, maxv, nbins)
+_energy_lut_cache = {}
+_ENERGY_LUT_CACHE_SIZE = 8
+
+
+def energy_bin_lut(corr_mat, minv, maxv, nbins):
+    '''(384, 4096) table of the energy bin of each (channel, ADC value)
+
+    Since ``germ_pd`` is a 12-bit ADC value, calibrating and binning a
+    photon reduces to one integer lookup in this table.  Entries outside
+    [minv, maxv] are -1.  Tables are cached on the content of the
+    calibration matrix and the bin spec.
+    '''
+    corr_mat = np.ascontiguousarray(corr_mat, dtype=float)
+    key = (hashlib.sha1(corr_mat).hexdigest(), minv, maxv, nbins)
+    lut = _energy_lut_cache.get(key)
+    if lut is None:
+        energy = (np.arange(N_ADC)*corr_mat[0, :, None] +
+                  corr_mat[1, :, None])
+        lut = _bin_index(energy, minv, maxv, nbins).astype(np.int32)
+        if len(_energy_lut_cache) >= _ENERGY_LUT_CACHE_SIZE:
+            _energy_lut_cache.pop(next(iter(_energy_lut_cache)))
+        _energy_lut_cache[key] = lut
+    return lut
+
+
+def benchmark_energy_binning(n_photons=10**6, n_events=10, corr_mat=None,
+                             bin_num=2000, seed=0):
+    '''Compare per-channel ``np.histogram`` binning to the lookup table
+
+    Bins ``n_events`` events of ``n_photons`` random photons each on
+    energy, the old way (a histogram per channel per event) and with
+    ``accumulate_mars_heatmap``.
+    '''
+    if corr_mat is None:
+        corr_mat = cal_val
+    rs = np.random.RandomState(seed)
+    events = [{'germ_chip': rs.randint(0, 12, n_photons),
+               'germ_chan': rs.randint(0, 32, n_photons),
+               'germ_pd': rs.randint(0, N_ADC, n_photons)}
+              for _ in range(n_events)]
+
+    t0 = time.time()
+    ref = np.zeros((bin_num, N_CHANNELS))
+    for data in events:
+        chan_ind = channel_index(data['germ_chip'], data['germ_chan'])
+        for i in range(N_CHANNELS):
+            gpd = data['germ_pd'][chan_ind == i]
+            bin_edges = np.linspace(0, 70, bin_num+1, endpoint=True)
+            eng_arr = gpd*corr_mat[0, i] + corr_mat[1, i]
+            ref[:, i] += np.histogram(eng_arr, bins=bin_edges)[0]
+    t_hist = time.time() - t0
+
+    _energy_lut_cache.clear()
+    t0 = time.time()
+    line = np.zeros((bin_num, N_CHANNELS))
+    for data in events:
+        accumulate_mars_heatmap(line, data, corr_mat, 0, 70)
+    t_lut = time.time() - t0
+
+    print("np.histogram per channel: {:.2f} s".format(t_hist))
+    print("lookup table (incl. build): {:.2f} s".format(t_lut))
+    print("counts differing: {}".format(int(np.abs(line - ref).sum())))
+    return {'histogram': t_hist, 'lut': t_lut}
 
 
 def make_mars_line(h, thresh=1000):
     '''Turns heard into counts per channel above thresh
     '''
-    line = np.zeros(12*32)
+    line = np.zeros((1, N_CHANNELS))
     for ev in db.get_events(h, fill=True):
-
-        df = pd.DataFrame(ev['data'])
-        for _, (chip, chan, ct) in (
-                (df[['germ_chip', 'germ_chan', 'germ_pd']]
-                 .groupby(('germ_chip', 'germ_chan'))
-                 .apply(lambda g: np.sum(g > thresh))['germ_pd'])
-                .reset_index()
-                .iterrows()):
-            line[chip*32 + chan] += ct
-    return line
+        accumulate_mars_heatmap(line, ev['data'], minv=0, maxv=N_ADC,
+                                thresh=thresh)
+    return line[0]
 
 
 def make_mars_heatmap(h):
     '''Make a spectrum khymography
 
     '''
-    bins = 4096
-    line = np.zeros((bins, 12*32))
+    line = np.zeros((N_ADC, N_CHANNELS))
     for ev in db.get_events(h, fill=True):
-        df = pd.DataFrame(ev['data'])
-        for (chip, chan), group in (df[['germ_chip', 'germ_chan', 'germ_pd']]
-                                    .groupby(('germ_chip', 'germ_chan'))):
-            gpd = group['germ_pd'].values
-            line[:, int(chip*32 + chan)] += np.bincount(gpd, minlength=bins)
-
+        accumulate_mars_heatmap(line, ev['data'])
     return line
 
 
 def make_mars_heatmap_after_correction(h, corr_mat=None,
-                                       minv=0, maxv=70, bin_num=2000):
+                                       minv=0, maxv=70, bin_num=2000,
+                                       by_run_time=False):
     '''Make a spectrum khymography
 
+    ``corr_mat`` defaults to ``cal_val``, or with ``by_run_time=True`` to
+    the calibration valid when the run was taken (``calibration_for_run``).
     '''
     if corr_mat is None:
-        corr_mat = cal_val
+        corr_mat = calibration_for_run(h) if by_run_time else cal_val
     bin_edges = np.linspace(minv, maxv, bin_num+1, endpoint=True)
-    line = np.zeros((bin_num, 12*32))
+    line = np.zeros((bin_num, N_CHANNELS))
     for ev in db.get_events(h, fill=True):
-        df = pd.DataFrame(ev['data'])
-        for (chip, chan), group in (df[['germ_chip', 'germ_chan', 'germ_pd']]
-                                    .groupby(('germ_chip', 'germ_chan'))):
-            gpd = group['germ_pd'].values
-            i = int(chip*32+chan)
-            eng_arr = gpd*corr_mat[0, i] + corr_mat[1, i]
-            line[:, i] += np.histogram(eng_arr, bins=bin_edges)[0]
-            # line[:, i] += np.bincount(gpd, minlength=bins)
+        accumulate_mars_heatmap(line, ev['data'], corr_mat, minv, maxv)
+    return line, bin_edges
+
+def _germ_datum_kwargs(resource, cache):
+    '''datum_id -> datum_kwargs of a resource, read once per resource'''
+    if resource['uid'] not in cache:
+        cache[resource['uid']] = {
+            datum['datum_id']: datum['datum_kwargs']
+            for datum in db.reg.datum_gen_given_resource(resource)}
+    return cache[resource['uid']]
+
+
+def _germ_h5_column(resource, datum_kwargs):
+    '''lazy column of a 'GeRM' (HDF5) resource, sliced on demand'''
+    import h5py
+    path = os.path.join(resource.get('root', ''), resource['resource_path'])
+    f = h5py.File(path, 'r')
+    return f, f[datum_kwargs['column']]
+
+
+def _germ_columns(ev, fields, datum_kwargs_cache):
+    '''Open the columns of one event without filling it
+
+    Returns a dict of sliceable arrays and a list of open files to close.
+    'GeRM' (HDF5) resources are read slice by slice straight from the file,
+    in the column named by the datum_kwargs.  Other specs, e.g.
+    'BinaryGeRM', go through the registered handler: each field of the
+    event is then loaded whole, so only the reduction is chunked.
+    ``datum_kwargs_cache`` is shared by the events of a run (see
+    ``_germ_datum_kwargs``).
+    '''
+    cols = {}
+    files = []
+    for field in fields:
+        datum_id = ev['data'][field]
+        resource = db.reg.resource_given_datum_id(datum_id)
+        if resource['spec'] == 'GeRM':
+            datum_kwargs = _germ_datum_kwargs(resource, datum_kwargs_cache)
+            f, col = _germ_h5_column(resource, datum_kwargs[datum_id])
+            files.append(f)
+        else:
+            col = db.reg.retrieve(datum_id)
+        cols[field] = col
+    return cols, files
+
+
+def iter_germ_chunks(h, fields=('germ_chip', 'germ_chan', 'germ_pd'),
+                     chunk_size=2**20, progress=True):
+    '''Yield the photons of a GeRM run in chunks, without filling events
+
+    Memory is bounded by ``chunk_size`` only for 'GeRM' (HDF5) resources;
+    'BinaryGeRM' events are read whole through their handler, one event
+    at a time, and then split into chunks: their on-disk layout belongs to
+    ``pygerm.handler.BinaryGeRMHandler``, so they are not memory-mapped
+    here.
+
+    Parameters
+    ----------
+    h : Header
+    fields : tuple of str, optional
+        the photon columns to read
+    chunk_size : int, optional
+        maximum number of photons per chunk
+    progress : bool or callable, optional
+        if True print progress, if callable it is called as
+        ``progress(n_events_done, n_events_total, n_photons_done)``
+
+    Yields
+    ------
+    chunk : dict
+        maps each field to an array of at most ``chunk_size`` photons
+    '''
+    if progress is True:
+        progress = _print_germ_progress
+    total = (h.stop or {}).get('num_events', {}).get('primary')
+    n_photons = 0
+    datum_kwargs_cache = {}
+    for n, ev in enumerate(db.get_events(h, fill=False), start=1):
+        cols, files = _germ_columns(ev, fields, datum_kwargs_cache)
+        try:
+            length = len(cols[fields[0]])
+            for start in range(0, length, chunk_size):
+                stop = min(start + chunk_size, length)
+                yield {k: np.asarray(v[start:stop]) for k, v in cols.items()}
+                n_photons += stop - start
+        finally:
+            for f in files:
+                f.close()
+        if progress:
+            progress(n, total, n_photons)
+
+
+def _print_germ_progress(n, total, n_photons):
+    print('\revent {}/{}, {} photons'.format(n, total or '?', n_photons),
+          end='', flush=True)
+
+
+def reduce_germ_run(h, corr_mat=None, minv=0, maxv=None, bin_num=N_ADC,
+                    thresh=None, chunk_size=2**20, progress=True):
+    '''Streaming version of the heatmap reductions, with bounded memory
+
+    The run is read with ``iter_germ_chunks`` and each chunk is added to a
+    running histogram with ``accumulate_mars_heatmap``, so at most
+    ``chunk_size`` photons are in memory at once.  The arguments are the
+    same as for ``accumulate_mars_heatmap``; by default this gives the raw
+    ADC heatmap of ``make_mars_heatmap``.
+
+    Returns
+    -------
+    line : ndarray
+        shape (bin_num, 384)
+    bin_edges : ndarray
+    '''
+    if maxv is None:
+        maxv = bin_num if corr_mat is None else 70
+    bin_edges = np.linspace(minv, maxv, bin_num+1, endpoint=True)
+    line = np.zeros((bin_num, N_CHANNELS))
+    for chunk in iter_germ_chunks(h, chunk_size=chunk_size,
+                                  progress=progress):
+        accumulate_mars_heatmap(line, chunk, corr_mat, minv, maxv,
+                                thresh=thresh)
+    if progress is True:
+        print()
     return line, bin_edges
 
 def plot_all_chan_spectrum(h, *, ax=None, **kwargs):
     spectrum, bins = make_mars_heatmap_after_correction(h, **kwargs)
-    
+    return plot_spectrum(spectrum, bins, ax=ax)
+
+
+def plot_spectrum(spectrum, bins, *, ax=None):
+    '''Plot an (energy x channel) spectrum with its two projections
+
+    The energy range of the top (per channel) projection is picked with a
+    span selector on the right axes.  ``spectrum`` is not copied, so it can
+    be updated in place and redrawn (see ``LiveGeRMSpectrum``).
+    '''
     if ax is None:
         fig, ax = plt.subplots(figsize=(13.5, 9.5))
     else:
@@ -219,8 +728,11 @@ def plot_all_chan_spectrum(h, *, ax=None, **kwargs):
                           textcoords='offset pixels',
                           va='top', ha='left')
 
-    
+    # current energy range of the top projection
+    e_range = [bins[0], bins[-1]]
+
     def update(lo, hi):
+        e_range[:] = lo, hi
         p_data = integrate_to_angles(spectrum, bins, lo, hi)
         p_line.set_ydata(p_data)
         ax_t.relim()
@@ -248,51 +760,263 @@ def plot_all_chan_spectrum(h, *, ax=None, **kwargs):
     
     return spectrum, bins, {'center': {'ax': ax, 'im': im},
                         'top': {'ax': ax_t, 'p_line': p_line},
-                        'right': {'ax': ax_r, 'e_line': e_line, 'span': span}}
+                        'right': {'ax': ax_r, 'e_line': e_line, 'span': span,
+                                  'range': e_range}}
 
 def integrate_to_angles(spectrum, bins, lo, hi):
     lo_ind, hi_ind = bins.searchsorted([lo, hi])
     return spectrum[lo_ind:hi_ind].sum(axis=0)
 
-def track_peaks(h, bin_num=3000):
+def track_peaks(h, bin_num=3000, by_run_time=False):
 
     lines = []
     angles = []
+    bin_edges = np.linspace(0, 70, bin_num+1, endpoint=True)
+    corr_mat = calibration_for_run(h) if by_run_time else cal_val
     for ev in db.get_events(h, fill=True):
-        df = pd.DataFrame(ev['data'])
         angles.append(ev['data']['diff_tth_i'])
-        line = np.zeros((bin_num, 12*32))
-        bin_edges = np.linspace(0, 70, bin_num+1, endpoint=True)
-        for (chip, chan), group in (df[['germ_chip', 'germ_chan', 'germ_pd']]
-                                    .groupby(('germ_chip', 'germ_chan'))):
-            gpd = group['germ_pd'].values
-            i = int(chip*32+chan)
-            eng_arr = gpd*cal_val[0, i] + cal_val[1, i]
-            line[:, i] += np.histogram(eng_arr, bins=bin_edges)[0]
-
+        line = np.zeros((bin_num, N_CHANNELS))
+        accumulate_mars_heatmap(line, ev['data'], corr_mat, 0, 70)
         lines.append(integrate_to_angles(line, bin_edges, 50, 54))
-        
+
     return np.array(lines), angles
 
-    
 
-# _cal_file = Path(os.path.realpath(__file__)).parent / 'data/calibration_matrix_20170720.txt'
-# this had wrong energies
-#_cal_file = Path(os.path.realpath(__file__)).parent / 'data/calibration_matrix_20171129.txt'
-# this one calibrated with more precise energies
-# _cal_file = Path(os.path.realpath(__file__)).parent / 'data/calibration_matrix_20171129_2.txt'
-_cal_file = Path(os.path.realpath(__file__)).parent / 'calibration_matrix_20171129.txt'
-_cal_file = Path(os.path.realpath(__file__)).parent / 'data/calibration_matrix_20171130.txt'
-cal_val = np.loadtxt(str(_cal_file))
+class LiveGeRMSpectrum(CallbackBase):
+    """Accumulate and plot the calibrated GeRM spectrum while a run goes
+
+    Each event is added to the (energy x channel) histogram as it arrives,
+    so the spectrum of ``plot_all_chan_spectrum`` is available (as
+    ``.spectrum`` and ``.bins``) as soon as the run ends, without reading
+    the run back.  The figure is redrawn at most every ``update_interval``
+    seconds, and once more at the end of the run.
+
+    Parameters
+    ----------
+    corr_mat : ndarray, optional
+        calibration matrix, defaults to ``cal_val``
+    minv, maxv, bin_num : optional
+        the energy bins, as in ``make_mars_heatmap_after_correction``
+    update_interval : float, optional
+        minimum time between redraws, in seconds
+    plot : bool, optional
+        if False only accumulate the spectrum
+
+    Example
+    -------
+    >>> lgs = LiveGeRMSpectrum()
+    >>> RE(bp.count([germ], num=10), lgs)
+    >>> lgs.spectrum
+    """
+    fields = ('germ_chip', 'germ_chan', 'germ_pd')
+
+    def __init__(self, corr_mat=None, minv=0, maxv=70, bin_num=2000,
+                 update_interval=1, plot=True):
+        super().__init__()
+        self.corr_mat = corr_mat
+        self.minv = minv
+        self.maxv = maxv
+        self.bins = np.linspace(minv, maxv, bin_num+1, endpoint=True)
+        self.spectrum = np.zeros((bin_num, N_CHANNELS))
+        self.update_interval = update_interval
+        self.plot = plot
+        self.artists = None
+        self._last_draw = 0
+
+    def start(self, doc):
+        self.spectrum[:] = 0
+        if self.corr_mat is None:
+            self.corr_mat = cal_val
+        if self.plot:
+            _, _, self.artists = plot_spectrum(self.spectrum, self.bins)
+        self._last_draw = 0
+        super().start(doc)
+
+    def event(self, doc):
+        if not all(k in doc['data'] for k in self.fields):
+            return
+        data = {k: self._fill(doc['data'][k]) for k in self.fields}
+        accumulate_mars_heatmap(self.spectrum, data, self.corr_mat,
+                                self.minv, self.maxv)
+        now = time.monotonic()
+        if now - self._last_draw >= self.update_interval:
+            self._last_draw = now
+            self.update_plot()
+        super().event(doc)
+
+    def stop(self, doc):
+        self.update_plot()
+        super().stop(doc)
+
+    @staticmethod
+    def _fill(value):
+        # events from the RunEngine carry datum ids for the photon columns
+        if isinstance(value, str):
+            return db.reg.retrieve(value)
+        return value
+
+    def update_plot(self):
+        if self.artists is None:
+            return
+        spectrum, bins = self.spectrum, self.bins
+        center, top, right = (self.artists['center'], self.artists['top'],
+                              self.artists['right'])
+        if not spectrum.any():
+            return
+        center['im'].set_data(np.ma.masked_less_equal(spectrum, 0))
+        center['im'].autoscale()
+        right['e_line'].set_xdata(spectrum.sum(axis=1))
+        top['p_line'].set_ydata(integrate_to_angles(spectrum, bins,
+                                                    *right['range']))
+        for ax in (top['ax'], right['ax']):
+            ax.relim()
+            ax.autoscale_view()
+        center['ax'].figure.canvas.draw_idle()
+
+
+# Calibration matrices are stored in data/ as calibration_*.npy, each with
+# a .json sidecar holding the time of the calibration run (used to pick
+# the matrix valid for a given run), its uid and the peak energies.
+# The hand-saved calibration_matrix_YYYYMMDD.txt files were converted to
+# this layout with convert_legacy_calibrations, dated by their file name
+# (a _N suffix, for a later one the same day, adds N seconds).
+# A calibration whose .json has a 'retired' reason is never picked.
+# History of those:
+#   20170720
+#   20171129 had wrong energies (retired)
+#   20171129_2 calibrated with more precise energies
+#   20171130 generated by run_cal('ea6f8286-e9e0-44da-9b30-7f433ea3319b')
+CAL_DIR = Path(os.path.realpath(__file__)).parent / 'data'
+
+# cal_dir -> sorted [(time, stem), ...], and stem path -> loaded matrix
+_calibration_index_cache = {}
+_calibration_cache = {}
+
+
+def convert_legacy_calibrations(cal_dir=CAL_DIR):
+    '''Store hand-saved calibration_matrix_YYYYMMDD.txt files as .npy/.json
+
+    This writes into ``cal_dir``: run it by hand when a new .txt file is
+    added, startup only reads the stored calibrations.
+    '''
+    cal_dir = Path(cal_dir)
+    for txt in sorted(cal_dir.glob('calibration_matrix_*.txt')):
+        meta_file = txt.with_suffix('.json')
+        if meta_file.exists():
+            continue
+        date, _, n = txt.stem[len('calibration_matrix_'):].partition('_')
+        stamp = (datetime.datetime.strptime(date, '%Y%m%d').timestamp() +
+                 int(n or 0))
+        np.save(str(txt.with_suffix('.npy')), np.loadtxt(str(txt)))
+        with open(str(meta_file), 'w') as f:
+            json.dump({'time': stamp, 'uid': None, 'source': txt.name}, f)
+    _calibration_index_cache.pop(cal_dir, None)
+
+
+def calibration_index(cal_dir=CAL_DIR):
+    '''sorted list of (time, name) of the stored, not retired, calibrations'''
+    cal_dir = Path(cal_dir)
+    index = _calibration_index_cache.get(cal_dir)
+    if index is None:
+        index = []
+        for meta_file in cal_dir.glob('calibration*.json'):
+            with open(str(meta_file)) as f:
+                meta = json.load(f)
+            if not meta.get('retired'):
+                index.append((meta['time'], meta_file.stem))
+        index.sort()
+        _calibration_index_cache[cal_dir] = index
+    return index
+
+
+def load_calibration(timestamp=None, cal_dir=CAL_DIR):
+    '''Return the calibration matrix valid at a given time
+
+    This is the most recent calibration taken at or before ``timestamp``
+    (a unix time), found by bisection in ``calibration_index``.
+
+    Parameters
+    ----------
+    timestamp : float, optional
+        defaults to the latest calibration
+    cal_dir : Path, optional
+
+    Returns
+    -------
+    cal_mat : ndarray
+        shape [2, 384], slope and intercept per channel
+    '''
+    index = calibration_index(cal_dir)
+    if timestamp is None:
+        i = len(index) - 1
+    else:
+        i = bisect.bisect_right(index, (timestamp, chr(0x10ffff))) - 1
+    if i < 0:
+        raise ValueError("No GeRM calibration in {} older than {}"
+                         .format(cal_dir, timestamp))
+    path = Path(cal_dir) / (index[i][1] + '.npy')
+    if path not in _calibration_cache:
+        _calibration_cache[path] = np.load(str(path))
+    return _calibration_cache[path]
+
+
+def calibration_for_run(h):
+    '''the calibration matrix valid when run ``h`` was taken'''
+    return load_calibration(h.start['time'])
+
+
+def save_calibration(cal_mat, uid=None, timestamp=None, cal_dir=CAL_DIR,
+                     **md):
+    '''Store a calibration matrix with its metadata
+
+    Parameters
+    ----------
+    cal_mat : ndarray
+        shape [2, 384], as returned by ``get_calibration_value``
+    uid : str, optional
+        uid of the calibration run
+    timestamp : float, optional
+        time from which the calibration is valid, defaults to now
+    cal_dir : Path, optional
+    **md
+        any other metadata, e.g. the peak energies
+
+    Returns
+    -------
+    path : Path
+        the .npy file written
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    stem = 'calibration_' + datetime.datetime.fromtimestamp(
+        timestamp).strftime('%Y%m%d-%H%M%S')
+    if uid is not None:
+        stem += '_' + uid[:8]
+    cal_dir = Path(cal_dir)
+    path = cal_dir / (stem + '.npy')
+    np.save(str(path), np.asarray(cal_mat))
+    meta = dict(md, time=timestamp, uid=uid, created=time.time())
+    with open(str(cal_dir / (stem + '.json')), 'w') as f:
+        json.dump(meta, f)
+    _calibration_index_cache.pop(cal_dir, None)
+    return path
+
+
+cal_val = load_calibration()
 
 # calibration data uid
 # cal_uid = "71b97506-7123-4af3-8d30-c566af324f95"
-def run_cal(cal_uid):
+def run_cal(cal_uid, processes=None, save=False):
     ''' test function to run calibration.
         meant to be a template to work on.
 
+        The channels are fit in ``processes`` worker processes (see
+        ``fit_all_channels``).  With ``save=True`` the result is stored
+        with ``save_calibration``, valid from the time of the calibration
+        run.
+
         Example:
-            cal_mat = run_cal()
+            cal_mat = run_cal(cal_uid, processes=4, save=True)
             # plot result (also returns the heat map)
             res = plot_all_chan_spectrum(hdr,corr_mat=cal_mat2)
             # the binned data
@@ -300,18 +1024,20 @@ def run_cal(cal_uid):
     '''
     hdr = db[cal_uid]
     im = make_mars_heatmap(hdr)
-    cens = fit_all_channels(im, plot=True)
+    cens = fit_all_channels(im, processes=processes)
     # change to numpy array for function
     cens = np.array(cens)
     # energies of the peaks in keV
     energies = np.array([17.4, 19.6, 59.5])
     cal_mat2 = get_calibration_value(cens, energies)
+    if save:
+        save_calibration(cal_mat2, uid=hdr.start['uid'],
+                         timestamp=hdr.start['time'],
+                         energies=energies.tolist())
     return cal_mat2
 
 # Generate calibration matrix:
-# cal_val = run_cal('ea6f8286-e9e0-44da-9b30-7f433ea3319b')
-# cal_file = '/home/xf28id1/.ipython/profile_collection_germ/startup/data/calibration_matrix_20171130.txt'
-# np.savetxt(cal_file, cal_val)
+# cal_val = run_cal('ea6f8286-e9e0-44da-9b30-7f433ea3319b', save=True)
 
 # How to take a count
 # http://nsls-ii.github.io/bluesky/plans_intro.html